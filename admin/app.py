@@ -15,7 +15,16 @@ from loguru import logger
 async def app_lifespan(app: FastAPI):
     conf = config.AppConfig()
     engine = create_engine(conf.db_url)
-    database.create_all_tables(engine)
+    database.migrate(engine)
+    engine.dispose()
+
+    async_engine = database.create_async_engine(
+        conf.db_url,
+        pool_size=conf.db_pool_size,
+        max_overflow=conf.db_max_overflow,
+        pool_timeout=conf.db_pool_timeout,
+        pool_recycle=conf.db_pool_recycle,
+    )
 
     async_rdb = redis.asyncio.Redis(
         host=conf.redis_host,
@@ -24,12 +33,13 @@ async def app_lifespan(app: FastAPI):
         decode_responses=True,
     )
 
-    app.state.db = engine
+    app.state.db = async_engine
     app.state.rdb = async_rdb
 
     yield
 
     await async_rdb.close()
+    await async_engine.dispose()
 
 
 conf = config.AppConfig()
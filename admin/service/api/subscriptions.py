@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends
 from .. import depends, models
 import database
-from sqlalchemy import Engine, delete
-from sqlmodel import Session, select
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from loguru import logger
 from pydantic import BaseModel
 
@@ -17,60 +19,63 @@ router = APIRouter(prefix="/subscription", dependencies=[Depends(depends.get_ses
 @router.post("/plan")
 async def add_new_plan(
     plan: database.subscription.SubscriptionPlans,
-    engine: Engine = Depends(depends.get_db),
+    engine: AsyncEngine = Depends(depends.get_db),
 ) -> models.APIResponse:
 
-    with Session(engine) as ses:
+    async with AsyncSession(engine) as ses:
         ses.add(plan)
-        ses.commit()
-        ses.refresh(plan)
+        await ses.commit()
+        await ses.refresh(plan)
         logger.info(f"add new subscription plan, id: {plan.id}")
 
     return models.APIResponse()
 
 
 @router.get("/plan")
-async def get_plans(engine: Engine = Depends(depends.get_db)) -> models.APIResponse:
-    with Session(engine) as ses:
-        plans = ses.exec(select(database.subscription.SubscriptionPlans)).all()
+async def get_plans(
+    engine: AsyncEngine = Depends(depends.get_db),
+) -> models.APIResponse:
+    async with AsyncSession(engine) as ses:
+        query = select(database.subscription.SubscriptionPlans)
+        plans = (await ses.exec(query)).all()
         return models.APIResponse(data=plans)
 
 
 @router.delete("/plan")
 async def delete_plans(
-    req: DeletePlansRequest, engine: Engine = Depends(depends.get_db)
+    req: DeletePlansRequest, engine: AsyncEngine = Depends(depends.get_db)
 ) -> models.APIResponse:
-    with Session(engine) as ses:
+    async with AsyncSession(engine) as ses:
         stmt = delete(database.subscription.SubscriptionPlans).where(
             database.subscription.SubscriptionPlans.id.in_(req.ids)  # type: ignore
         )
-        ses.exec(stmt)  # type: ignore
-        ses.commit()
+        await ses.exec(stmt)  # type: ignore
+        await ses.commit()
 
     return models.APIResponse()
 
 
 @router.post("/plan/{pid}/enable")
 async def disenable_plan(
-    pid: int, engine: Engine = Depends(depends.get_db)
+    pid: int, engine: AsyncEngine = Depends(depends.get_db)
 ) -> models.APIResponse:
-    with Session(engine) as ses:
-        plan = ses.get(database.subscription.SubscriptionPlans, pid)
+    async with AsyncSession(engine) as ses:
+        plan = await ses.get(database.subscription.SubscriptionPlans, pid)
         if plan:
             plan.enable = True
-            ses.commit()
+            await ses.commit()
 
     return models.APIResponse()
 
 
 @router.post("/plan/{pid}/disable")
 async def enable_plan(
-    pid: int, engine: Engine = Depends(depends.get_db)
+    pid: int, engine: AsyncEngine = Depends(depends.get_db)
 ) -> models.APIResponse:
-    with Session(engine) as ses:
-        plan = ses.get(database.subscription.SubscriptionPlans, pid)
+    async with AsyncSession(engine) as ses:
+        plan = await ses.get(database.subscription.SubscriptionPlans, pid)
         if plan:
             plan.enable = False
-            ses.commit()
+            await ses.commit()
 
     return models.APIResponse()
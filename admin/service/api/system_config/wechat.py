@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends
 from ... import depends
 from ...models import APIResponse
-from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
 import sysconf
 from pydantic import BaseModel
 
@@ -18,8 +18,8 @@ router = APIRouter(prefix="/wechat", dependencies=[Depends(depends.get_session)]
 
 
 @router.get("/secrets", response_model=APIResponse, response_model_exclude_none=True)
-async def get_secrets(db: Engine = Depends(depends.get_db)) -> APIResponse:
-    secrets = sysconf.wechat.Config(db).secrets
+async def get_secrets(db: AsyncEngine = Depends(depends.get_db)) -> APIResponse:
+    secrets = await sysconf.wechat.Config(db).secrets()
 
     if secrets:
         return APIResponse(data=secrets)
@@ -29,19 +29,19 @@ async def get_secrets(db: Engine = Depends(depends.get_db)) -> APIResponse:
 
 @router.post("/secrets", response_model=APIResponse, response_model_exclude_none=True)
 async def set_secrets(
-    secrets: sysconf.wechat.Secrets, db: Engine = Depends(depends.get_db)
+    secrets: sysconf.wechat.Secrets, db: AsyncEngine = Depends(depends.get_db)
 ) -> APIResponse:
 
     conf = sysconf.wechat.Config(db)
-    conf.secrets = secrets
+    await conf.set_secrets(secrets)
     return APIResponse()
 
 
 @router.get(
     "/login_callback", response_model=APIResponse, response_model_exclude_none=True
 )
-async def get_login_callback(db: Engine = Depends(depends.get_db)) -> APIResponse:
-    callback = sysconf.wechat.Config(db).login_redirect_url
+async def get_login_callback(db: AsyncEngine = Depends(depends.get_db)) -> APIResponse:
+    callback = await sysconf.wechat.Config(db).login_redirect_url()
     if callback:
         return APIResponse(data={"url": callback})
     else:
@@ -50,18 +50,20 @@ async def get_login_callback(db: Engine = Depends(depends.get_db)) -> APIRespons
 
 @router.post("/login_callback")
 async def set_login_callback(
-    req: SetUrlReq, db: Engine = Depends(depends.get_db)
+    req: SetUrlReq, db: AsyncEngine = Depends(depends.get_db)
 ) -> APIResponse:
     conf = sysconf.wechat.Config(db)
-    conf.login_redirect_url = req.url
+    await conf.set_login_redirect_url(req.url)
     return APIResponse()
 
 
 @router.get(
     "/payment_callback", response_model=APIResponse, response_model_exclude_none=True
 )
-async def get_payment_callback(db: Engine = Depends(depends.get_db)) -> APIResponse:
-    callback = sysconf.wechat.Config(db).payment_callback_url
+async def get_payment_callback(
+    db: AsyncEngine = Depends(depends.get_db),
+) -> APIResponse:
+    callback = await sysconf.wechat.Config(db).payment_callback_url()
     if callback:
         return APIResponse(data={"url": callback})
     else:
@@ -70,18 +72,18 @@ async def get_payment_callback(db: Engine = Depends(depends.get_db)) -> APIRespo
 
 @router.post("/payment_callback")
 async def set_payment_callback(
-    req: SetUrlReq, db: Engine = Depends(depends.get_db)
+    req: SetUrlReq, db: AsyncEngine = Depends(depends.get_db)
 ) -> APIResponse:
     conf = sysconf.wechat.Config(db)
-    conf.payment_callback_url = req.url
+    await conf.set_payment_callback_url(req.url)
     return APIResponse()
 
 
 @router.get(
     "/payment_expires", response_model=APIResponse, response_model_exclude_none=True
 )
-async def get_payment_expires(db: Engine = Depends(depends.get_db)) -> APIResponse:
-    seconds = sysconf.wechat.Config(db).payment_expires
+async def get_payment_expires(db: AsyncEngine = Depends(depends.get_db)) -> APIResponse:
+    seconds = await sysconf.wechat.Config(db).payment_expires()
     if seconds:
         return APIResponse(data={"seconds": seconds})
     else:
@@ -90,8 +92,8 @@ async def get_payment_expires(db: Engine = Depends(depends.get_db)) -> APIRespon
 
 @router.post("/payment_expires")
 async def set_payment_expires(
-    req: SetIntReq, db: Engine = Depends(depends.get_db)
+    req: SetIntReq, db: AsyncEngine = Depends(depends.get_db)
 ) -> APIResponse:
     conf = sysconf.wechat.Config(db)
-    conf.payment_expires = req.val
+    await conf.set_payment_expires(req.val)
     return APIResponse()
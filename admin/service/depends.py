@@ -1,5 +1,5 @@
 from fastapi import Depends, Request, FastAPI, Header, HTTPException
-from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
 import redis.asyncio as redis
 from . import session
 
@@ -8,7 +8,7 @@ def get_app(req: Request) -> FastAPI:
     return req.app
 
 
-def get_db(app: FastAPI = Depends(get_app)) -> Engine:
+def get_db(app: FastAPI = Depends(get_app)) -> AsyncEngine:
     return app.state.db
 
 
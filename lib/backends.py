@@ -0,0 +1,285 @@
+import asyncio
+import contextlib
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Sequence
+
+import httpx
+from loguru import logger
+
+import httpclient
+
+# Backend fail this many times in a row is ejected for a while.
+MAX_FAILURES = 3
+EJECT_SECONDS = 30
+
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 5
+
+# In flight limit of each backend adjust by AIMD, add about one every
+# limit requests complete in time, multiply by BACKOFF when backend error
+# or a request take LATENCY_TOLERANCE times longer than average of its path.
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+MAX_LIMIT = 64
+BACKOFF = 0.7
+LATENCY_TOLERANCE = 2.0
+EWMA_ALPHA = 0.1
+
+# Check again in this seconds when no backend available, ejection may expire.
+CAPACITY_WAIT = 1
+
+
+# Limit never above connections httpclient allow to a host, requests over
+# it only wait in client, latency of them tell nothing about backend.
+def max_limit() -> int:
+    return max(min(MAX_LIMIT, httpclient.per_host_limit()), MIN_LIMIT)
+
+
+# One inference host, all hosts of a pool serve same endpoints.
+class Backend:
+
+    def __init__(self, url: str, weight: int = 1) -> None:
+        self.url: str = url.rstrip("/")
+        self.weight: int = max(weight, 1)
+        self.outstanding: int = 0
+        self.failures: int = 0
+        self.ejected_until: float = 0
+
+        # Weight only decide where limit start, then it follow the backend.
+        self.limit: float = min(INITIAL_LIMIT * self.weight, max_limit())
+        self.error_rate: float = 0
+        self.latency: dict[str, float] = {}
+        self.last_decrease: float = 0
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def capacity(self) -> int:
+        return max(min(int(self.limit), max_limit()), MIN_LIMIT)
+
+    @property
+    def load(self) -> float:
+        return self.outstanding / self.limit
+
+    # Record a complete request before it leave outstanding.
+    def record(self, path: str, started: float, error: bool) -> None:
+        elapsed = time.monotonic() - started
+        self.error_rate += EWMA_ALPHA * ((1 if error else 0) - self.error_rate)
+
+        average = self.latency.get(path)
+        congested = error or (
+            average is not None and elapsed > average * LATENCY_TOLERANCE
+        )
+        if not error:
+            average = elapsed if average is None else average
+            self.latency[path] = average + EWMA_ALPHA * (elapsed - average)
+
+        if congested:
+            # Requests sent before last decrease saw the old limit, skip them,
+            # so one burst of errors only decrease once.
+            if started > self.last_decrease:
+                self.limit = max(self.limit * BACKOFF, MIN_LIMIT)
+                self.last_decrease = time.monotonic()
+                logger.debug(f"inference backend {self.url} limit {self.limit:.2f}")
+
+        # Only grow when limit is reached, idle backend keep its limit.
+        elif self.outstanding >= self.capacity:
+            self.limit = min(self.limit + 1 / self.limit, max_limit())
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "limit": round(self.limit, 2),
+            "outstanding": self.outstanding,
+            "error_rate": round(self.error_rate, 3),
+            "latency": {p: round(v, 3) for p, v in self.latency.items()},
+            "ejected": self.ejected,
+        }
+
+    def succeed(self) -> None:
+        if self.failures >= MAX_FAILURES:
+            logger.info(f"inference backend {self.url} recovered")
+        self.failures = 0
+        self.ejected_until = 0
+
+    # Still failing after ejection expired eject it again at once.
+    def fail(self) -> None:
+        self.failures += 1
+        if self.failures >= MAX_FAILURES:
+            if not self.ejected:
+                logger.warning(
+                    f"inference backend {self.url} failed {self.failures} times, "
+                    f"eject for {EJECT_SECONDS}s"
+                )
+            self.ejected_until = time.monotonic() + EJECT_SECONDS
+
+    def __str__(self) -> str:
+        return self.url
+
+
+class Pool:
+
+    def __init__(self, backends: Sequence[Backend]) -> None:
+        if not backends:
+            raise ValueError("pool must have at least one backend")
+        self.backends: list[Backend] = list(backends)
+        self.__released = asyncio.Event()
+
+    # Least outstanding requests relative to limit, random one if tie,
+    # None if all backends reach their limits.
+    # All ejected means whole pool is down, still try the one recover first.
+    def pick(self) -> Backend | None:
+        healthy = [b for b in self.backends if not b.ejected]
+        if not healthy:
+            healthy = [min(self.backends, key=lambda b: b.ejected_until)]
+
+        ready = [b for b in healthy if b.outstanding < b.capacity]
+        if not ready:
+            return None
+
+        least = min(b.load for b in ready)
+        return random.choice([b for b in ready if b.load == least])
+
+    async def acquire(self) -> Backend:
+        while (backend := self.pick()) is None:
+            self.__released.clear()
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self.__released.wait(), CAPACITY_WAIT)
+        backend.outstanding += 1
+        return backend
+
+    def release(self, backend: Backend) -> None:
+        backend.outstanding -= 1
+        self.__released.set()
+
+    # Wait a backend under its limit and count request as outstanding.
+    # Transport error and 5xx count as failure, 429 only decrease limit.
+    @asynccontextmanager
+    async def use(self, path: str = "") -> AsyncIterator[Backend]:
+        backend = await self.acquire()
+        started = time.monotonic()
+        try:
+            yield backend
+        except httpx.HTTPStatusError as exc:
+            status = exc.response.status_code
+            if status >= 500:
+                backend.fail()
+            else:
+                backend.succeed()
+            if status >= 500 or status == 429:
+                backend.record(path, started, error=True)
+            raise
+        except httpx.TransportError:
+            backend.fail()
+            backend.record(path, started, error=True)
+            raise
+        else:
+            backend.succeed()
+            backend.record(path, started, error=False)
+        finally:
+            self.release(backend)
+
+    # Path after backend url if url point to this pool.
+    def match(self, url: str) -> tuple[int, str] | None:
+        for b in self.backends:
+            path = url[len(b.url) :]
+            if url.startswith(b.url) and (not path or path[0] in "/?"):
+                return (len(b.url), path)
+        return None
+
+    async def check(self) -> None:
+        client = httpclient.get()
+
+        async def probe(b: Backend) -> None:
+            # Any response means host is serving, even 404 for no such path.
+            try:
+                resp = await client.get(b.url + "/", timeout=HEALTH_CHECK_TIMEOUT)
+                if resp.status_code >= 500:
+                    b.fail()
+                else:
+                    b.succeed()
+            except httpx.HTTPError:
+                b.fail()
+
+        await asyncio.gather(*[probe(b) for b in self.backends])
+
+
+_pools: list[Pool] = []
+
+
+# Register hosts serve same endpoints, inference url begin with any of them
+# will be routed to whole pool. Pools share a host with them merged in place,
+# hosts already registered keep their state, weight changed only if given.
+def register(urls: Sequence[str], weights: Sequence[int] | None = None) -> Pool:
+    if weights is not None and len(weights) != len(urls):
+        raise ValueError("weights must match urls")
+
+    given: dict[str, int] = {}
+    if weights is not None:
+        given = {url.rstrip("/"): weight for url, weight in zip(urls, weights)}
+    hosts = list(dict.fromkeys(url.rstrip("/") for url in urls))
+
+    merged = [p for p in _pools if set(hosts) & {b.url for b in p.backends}]
+    if merged:
+        pool = merged[0]
+        for other in merged[1:]:
+            pool.backends.extend(other.backends)
+            _pools.remove(other)
+    else:
+        pool = Pool([Backend(host, given.get(host, 1)) for host in hosts])
+        _pools.append(pool)
+
+    registered = {b.url: b for b in pool.backends}
+    for host in hosts:
+        backend = registered.get(host)
+        if backend is None:
+            pool.backends.append(Backend(host, given.get(host, 1)))
+        elif host in given:
+            backend.weight = max(given[host], 1)
+
+    logger.info(f"inference backends: {', '.join(b.url for b in pool.backends)}")
+    return pool
+
+
+def find(url: str) -> tuple[Pool, str] | None:
+    best: tuple[int, Pool, str] | None = None
+    for pool in _pools:
+        m = pool.match(url)
+        if m and (best is None or m[0] > best[0]):
+            best = (m[0], pool, m[1])
+    return (best[1], best[2]) if best else None
+
+
+# Yield url rewrite to the backend picked, url not belong to any pool as is.
+@asynccontextmanager
+async def resolve(url: str) -> AsyncIterator[str]:
+    found = find(url)
+    if not found:
+        yield url
+        return
+
+    pool, path = found
+    async with pool.use(path.split("?")[0]) as backend:
+        yield backend.url + path
+
+
+def stats() -> list[dict[str, Any]]:
+    return [b.stats() for p in _pools for b in p.backends]
+
+
+async def check_forever(interval: float = HEALTH_CHECK_INTERVAL) -> None:
+    while True:
+        try:
+            await asyncio.gather(*[p.check() for p in _pools if len(p.backends) > 1])
+            for s in stats():
+                logger.debug(f"inference backend {s}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.error(f"inference backend health check error: {exc}")
+        await asyncio.sleep(interval)
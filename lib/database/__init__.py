@@ -1,9 +1,5 @@
-from . import config, inference, subscription, user, pay, wechat  # type: ignore
-from sqlalchemy import Engine
+from . import config, inference, subscription, user, pay, wechat, points  # type: ignore
+from . import migration  # type: ignore
+from .migration import migrate  # type: ignore
+from .aio import create_async_engine  # type: ignore
 from sqlmodel import create_engine  # type: ignore
-
-
-def create_all_tables(engine: Engine) -> None:
-    from sqlmodel import SQLModel
-
-    SQLModel.metadata.create_all(engine)
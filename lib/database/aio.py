@@ -0,0 +1,39 @@
+from sqlalchemy import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import create_async_engine as _create_async_engine
+
+# Async driver for each sync driver may appear in config url.
+_ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+mysqlconnector": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+# Config keep one url for both sync and async engine, replace driver here.
+def async_url(url: str) -> str:
+    u = make_url(url)
+    driver = _ASYNC_DRIVERS.get(u.drivername, u.drivername)
+    return u.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def create_async_engine(
+    url: str,
+    pool_size: int = 10,
+    max_overflow: int = 20,
+    pool_timeout: int = 10,
+    pool_recycle: int = 1800,
+) -> AsyncEngine:
+
+    # Check connection before use and recycle it before mysql wait_timeout,
+    # so request never get a connection already closed by server.
+    return _create_async_engine(
+        async_url(url),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=True,
+    )
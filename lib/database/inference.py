@@ -1,6 +1,6 @@
 from enum import IntEnum
 from sqlmodel import SQLModel, Field
-from sqlalchemy import Column
+from sqlalchemy import Column, Index
 from sqlalchemy.dialects.mysql import TEXT, LONGTEXT
 from datetime import datetime
 
@@ -44,6 +44,12 @@ class State(IntEnum):
 class Log(SQLModel, table=True):
 
     __tablename__ = "inference_log"  # type: ignore
+    __table_args__ = (
+        # Dispatcher claim waiting logs of a type by create time.
+        Index("ix_inference_log_state_type_ctime", "state", "type", "ctime"),
+        # Gallery list logs of a user by create time, filter out some types.
+        Index("ix_inference_log_uid_ctime_type", "uid", "ctime", "type"),
+    )
 
     id: int | None = Field(default=None, primary_key=True)
     uid: int = Field(index=True)
@@ -56,3 +62,10 @@ class Log(SQLModel, table=True):
     utime: datetime = Field(default_factory=datetime.now)
     request: str = Field(default="", sa_column=Column(LONGTEXT))
     response: str = Field(default="", sa_column=Column(LONGTEXT))
+    worker: str | None = Field(default=None, max_length=128)
+    claim_time: datetime | None = None
+    # Claimed log belongs to worker until lease expired, count claims to stop retry.
+    lease_until: datetime | None = None
+    attempts: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    # Add one on every state change, state may go back when log requeued.
+    seq: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
@@ -0,0 +1,254 @@
+from collections.abc import Callable, Sequence
+from datetime import datetime
+from typing import Any, NamedTuple
+
+from loguru import logger
+from sqlalchemy import Connection, Engine, Index, inspect, text
+from sqlalchemy.schema import CreateColumn
+from sqlmodel import Field, SQLModel, asc, col, desc, func, select
+
+from . import inference, points, subscription
+
+
+# Each applied migration recorded here, migration only run once.
+class SchemaVersion(SQLModel, table=True):
+
+    __tablename__ = "schema_version"  # type: ignore
+
+    version: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    name: str = Field(max_length=128)
+    applied: datetime = Field(default_factory=datetime.now)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+# Migration must be safe to run on database created by any older code,
+# so check before create or alter anything.
+
+
+def add_column_if_missing(conn: Connection, table: str, column: str) -> None:
+    exists = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column in exists:
+        return
+
+    col = SQLModel.metadata.tables[table].columns[column]
+    ddl = CreateColumn(col).compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl}"))
+
+
+def create_index_if_missing(conn: Connection, table: str, name: str) -> None:
+    exists = {i["name"] for i in inspect(conn).get_indexes(table)}
+    if name in exists:
+        return
+
+    index: Index | None = None
+    for i in SQLModel.metadata.tables[table].indexes:
+        if i.name == name:
+            index = i
+    if index is None:
+        raise KeyError(f"no index {name} defined on table {table}")
+
+    logger.info(f"create index {name} on {table}")
+    index.create(conn)
+
+
+# Column type changed in model, mysql enum need redefine to accept new value.
+def modify_column(conn: Connection, table: str, column: str) -> None:
+    if conn.dialect.name != "mysql":
+        return
+
+    col = SQLModel.metadata.tables[table].columns[column]
+    ddl = CreateColumn(col).compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table} MODIFY COLUMN {ddl}"))
+
+
+def create_tables(conn: Connection) -> None:
+    SQLModel.metadata.create_all(conn)
+
+
+def add_inference_claim_columns(conn: Connection) -> None:
+    add_column_if_missing(conn, "inference_log", "worker")
+    add_column_if_missing(conn, "inference_log", "claim_time")
+
+
+def add_hot_path_indexes(conn: Connection) -> None:
+    create_index_if_missing(conn, "subscriptions", "ix_subscriptions_uid_expired")
+    create_index_if_missing(conn, "inference_log", "ix_inference_log_state_type_ctime")
+    create_index_if_missing(conn, "inference_log", "ix_inference_log_uid_ctime_type")
+
+
+def create_point_ledger(conn: Connection) -> None:
+    points.Ledger.__table__.create(conn, checkfirst=True)  # type: ignore
+
+
+def add_inference_lease_columns(conn: Connection) -> None:
+    add_column_if_missing(conn, "inference_log", "lease_until")
+    add_column_if_missing(conn, "inference_log", "attempts")
+
+
+def add_inference_seq_column(conn: Connection) -> None:
+    add_column_if_missing(conn, "inference_log", "seq")
+
+
+def add_point_ledger_reasons(conn: Connection) -> None:
+    modify_column(conn, "point_ledger", "reason")
+
+
+# Append new migration to the end, never change or remove applied one.
+MIGRATIONS: Sequence[Migration] = [
+    Migration(1, "create tables", create_tables),
+    Migration(2, "add inference log claim columns", add_inference_claim_columns),
+    Migration(3, "add hot path indexes", add_hot_path_indexes),
+    Migration(4, "create point ledger", create_point_ledger),
+    Migration(5, "add inference log lease columns", add_inference_lease_columns),
+    Migration(6, "add inference log seq column", add_inference_seq_column),
+    Migration(7, "add point ledger reasons", add_point_ledger_reasons),
+]
+
+_LOCK_NAME = "aigc_schema_migration"
+
+
+def migrate(engine: Engine) -> None:
+    with engine.connect() as conn:
+
+        # Replicas may start at same time, only one of them do migration.
+        if conn.dialect.name == "mysql":
+            locked = conn.execute(
+                text("SELECT GET_LOCK(:name, 300)"), {"name": _LOCK_NAME}
+            ).scalar()
+            if locked != 1:
+                raise TimeoutError("wait schema migration lock timeout")
+
+        try:
+            SchemaVersion.__table__.create(conn, checkfirst=True)  # type: ignore
+            conn.commit()
+
+            applied = set(conn.execute(select(SchemaVersion.version)).scalars())
+            for m in MIGRATIONS:
+                if m.version in applied:
+                    continue
+
+                logger.info(f"apply schema migration {m.version}: {m.name}")
+                m.upgrade(conn)
+                conn.execute(
+                    SchemaVersion.__table__.insert().values(  # type: ignore
+                        version=m.version, name=m.name, applied=datetime.now()
+                    )
+                )
+                conn.commit()
+        finally:
+            if conn.dialect.name == "mysql":
+                conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": _LOCK_NAME})
+
+
+# Queries run on every request or dispatch, they must be served by index.
+def hot_queries() -> dict[str, Any]:
+    Log = inference.Log
+    Sub = subscription.Subscription
+    Ledger = points.Ledger
+
+    # Same as Server.schedule, first waiting logs of each user in a lane.
+    rank = (
+        func.row_number()
+        .over(partition_by=col(Log.uid), order_by=asc(Log.ctime))
+        .label("rank")
+    )
+    waiting = (
+        select(Log.tid, Log.uid, Log.ctime, rank)
+        .where(Log.state == inference.State.waiting)
+        .where(Log.type == inference.Type.segment_any)
+        .subquery()
+    )
+
+    return {
+        "current subscription": select(Sub)
+        .where(Sub.uid == 1)
+        .where(Sub.expired == False),
+        "schedule waiting inference": select(
+            waiting.c.tid, waiting.c.uid, waiting.c.ctime
+        )
+        .where(waiting.c.rank <= 10)
+        .order_by(waiting.c.ctime),
+        "schedule running count": select(Log.uid, func.count())
+        .where(Log.state == inference.State.in_progress)
+        .where(Log.type == inference.Type.segment_any)
+        .where(col(Log.uid).in_([1, 2]))
+        .group_by(col(Log.uid)),
+        "schedule paid users": select(Sub.uid)
+        .where(col(Sub.uid).in_([1, 2]))
+        .where(Sub.stype == subscription.Type.subscription)
+        .where(Sub.expired == False),
+        "claim scheduled inference": select(Log)
+        .where(col(Log.tid).in_(["tid"]))
+        .where(Log.state == inference.State.waiting)
+        .with_for_update(skip_locked=True),
+        "gallery history": select(Log)
+        .where(Log.uid == 1)
+        .where(Log.type != inference.Type.segment_any)
+        .order_by(desc(Log.ctime))
+        .limit(20),
+        "gallery history count": select(func.count())
+        .select_from(Log)
+        .where(Log.uid == 1)
+        .where(Log.type != inference.Type.segment_any),
+        "inference by tid": select(Log).where(Log.uid == 1).where(Log.tid == "tid"),
+        "reserved points by tid": select(Ledger)
+        .where(Ledger.tid == "tid")
+        .where(Ledger.reason == points.Reason.reserve),
+        "reset after reservation": select(Ledger.id)
+        .where(Ledger.uid == 1)
+        .where(Ledger.sid == 1)
+        .where(Ledger.reason == points.Reason.reset)
+        .where(col(Ledger.id) > 1)
+        .limit(1),
+    }
+
+
+# Run EXPLAIN of hot queries, return name of queries which scan full table.
+def explain_hot_queries(engine: Engine) -> list[str]:
+    if engine.dialect.name != "mysql":
+        logger.warning("explain hot queries only support mysql")
+        return []
+
+    full_scans: list[str] = []
+    with engine.connect() as conn:
+        for name, query in hot_queries().items():
+            sql = query.compile(
+                dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+            )
+            plans = conn.execute(text(f"EXPLAIN {sql}")).mappings().all()
+
+            for plan in plans:
+                logger.debug(f"explain {name}: {dict(plan)}")
+
+                # Derived table always scanned, its own query checked by rows below.
+                if str(plan["table"]).startswith("<derived"):
+                    continue
+
+                if plan["type"] == "ALL" or plan["key"] is None:
+                    full_scans.append(name)
+                    logger.warning(f"hot query '{name}' not use index: {dict(plan)}")
+                    break
+
+    return full_scans
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+    from sqlmodel import create_engine
+
+    parser = ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--explain", action="store_true")
+    arguments = parser.parse_args()
+
+    engine = create_engine(arguments.url)
+    migrate(engine)
+
+    if arguments.explain and len(explain_hot_queries(engine)) != 0:
+        raise SystemExit(1)
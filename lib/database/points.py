@@ -0,0 +1,31 @@
+from enum import StrEnum
+from sqlmodel import SQLModel, Field
+from sqlalchemy import UniqueConstraint
+from datetime import datetime
+
+
+class Reason(StrEnum):
+    reserve = "reserve"
+    settle = "settle"
+    refund = "refund"
+    grant = "grant"
+    reset = "reset"
+    void = "void"
+
+
+# Append only, every change of subscription remains write one row here,
+# a refund voided when a reset already gave the reserved points back.
+class Ledger(SQLModel, table=True):
+
+    __tablename__ = "point_ledger"  # type: ignore
+
+    # One inference only reserve, settle or refund once.
+    __table_args__ = (UniqueConstraint("tid", "reason", name="uq_point_ledger_tid_reason"),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    uid: int = Field(index=True)
+    sid: int
+    tid: str | None = Field(default=None, max_length=32)
+    delta: int
+    reason: Reason
+    ctime: datetime = Field(default_factory=datetime.now)
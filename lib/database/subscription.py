@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import Index
 from enum import StrEnum
 from datetime import datetime
 
@@ -25,6 +26,7 @@ class RefreshLog(SQLModel, table=True):
 class Subscription(SQLModel, table=True):
 
     __tablename__ = "subscriptions"  # type: ignore
+    __table_args__ = (Index("ix_subscriptions_uid_expired", "uid", "expired"),)
 
     id: int | None = Field(default=None, primary_key=True)
     uid: int
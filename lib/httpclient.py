@@ -0,0 +1,206 @@
+import asyncio
+import importlib.util
+import secrets
+from enum import StrEnum
+from typing import AsyncIterable, AsyncIterator, Mapping
+
+import httpx
+from loguru import logger
+
+
+# Each profile own a client, so slow inference never occupy connections
+# needed by callbacks or wechat api.
+class Profile(StrEnum):
+    # Wechat api and rpc between our services.
+    default = "default"
+    # Inference backends, one request may take minutes.
+    inference = "inference"
+    # Task callbacks, must not block dispatcher for long.
+    callback = "callback"
+    # Download images from remote storage.
+    download = "download"
+
+
+_TIMEOUTS: dict[Profile, httpx.Timeout] = {
+    Profile.default: httpx.Timeout(30.0, connect=5.0),
+    Profile.inference: httpx.Timeout(None, connect=10.0),
+    Profile.callback: httpx.Timeout(30.0, connect=5.0),
+    Profile.download: httpx.Timeout(60.0, connect=10.0),
+}
+
+_max_connections: int = 100
+_max_keepalive: int = 20
+_keepalive_expiry: float = 60.0
+_per_host: int = 20
+_http2: bool = False
+
+_clients: dict[Profile, httpx.AsyncClient] = {}
+
+
+async def init(
+    max_connections: int = 100,
+    max_keepalive: int = 20,
+    keepalive_expiry: float = 60.0,
+    per_host: int = 20,
+    http2: bool = False,
+) -> None:
+    global _max_connections
+    global _max_keepalive
+    global _keepalive_expiry
+    global _per_host
+    global _http2
+
+    # Clients created before init use old limits, close them.
+    await close()
+
+    # HTTP/2 is optional, it need h2 package installed.
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("h2 not installed, fallback to http/1.1")
+        http2 = False
+
+    _max_connections = max_connections
+    _max_keepalive = max_keepalive
+    _keepalive_expiry = keepalive_expiry
+    _per_host = per_host
+    _http2 = http2
+
+
+# Max requests in flight to one host, more wait in client.
+def per_host_limit() -> int:
+    return _per_host
+
+
+# Shared client of profile, never close it, call close() when process exit.
+def get(profile: Profile = Profile.default) -> httpx.AsyncClient:
+    client = _clients.get(profile)
+    if client is None or client.is_closed:
+        client = _make_client(profile)
+        _clients[profile] = client
+    return client
+
+
+async def close() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+def _make_client(profile: Profile) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=_max_connections,
+        max_keepalive_connections=_max_keepalive,
+        keepalive_expiry=_keepalive_expiry,
+    )
+    transport = httpx.AsyncHTTPTransport(limits=limits, http2=_http2)
+    return httpx.AsyncClient(
+        timeout=_TIMEOUTS[profile],
+        transport=_HostLimitedTransport(transport, _per_host),
+    )
+
+
+# httpx only limit connections of whole pool, limit each host here,
+# so one slow backend never take all connections of pool.
+class _HostLimitedTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, per_host: int) -> None:
+        self.__transport = transport
+        self.__per_host = per_host
+        self.__hosts: dict[tuple[bytes, bytes, int | None], asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = request.url
+        key = (url.raw_scheme, url.raw_host, url.port)
+        sem = self.__hosts.get(key)
+        if sem is None:
+            sem = asyncio.Semaphore(self.__per_host)
+            self.__hosts[key] = sem
+
+        await sem.acquire()
+        try:
+            response = await self.__transport.handle_async_request(request)
+        except BaseException:
+            sem.release()
+            raise
+
+        # Connection still in use until body read, release slot when closed.
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        response.stream = _ReleaseOnClose(response.stream, sem)
+        return response
+
+    async def aclose(self) -> None:
+        await self.__transport.aclose()
+
+
+class _ReleaseOnClose(httpx.AsyncByteStream):
+
+    def __init__(self, stream: httpx.AsyncByteStream, sem: asyncio.Semaphore) -> None:
+        self.__stream = stream
+        self.__sem: asyncio.Semaphore | None = sem
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.__stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.__stream.aclose()
+        finally:
+            if self.__sem is not None:
+                self.__sem.release()
+                self.__sem = None
+
+
+# Body of multipart/form-data with text fields and one file, file content
+# pass through in chunks, never joined in memory. Length of file must be
+# known, so whole body have content length instead of chunked encoding.
+class MultipartStream:
+
+    def __init__(
+        self,
+        fields: Mapping[str, str],
+        name: str,
+        filename: str,
+        content_type: str,
+        content: bytes | AsyncIterable[bytes],
+        length: int,
+    ) -> None:
+        boundary = secrets.token_hex(16)
+
+        head = b""
+        for key, value in fields.items():
+            head += (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{_quote(key)}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode()
+        head += (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{_quote(name)}"; '
+            f'filename="{_quote(filename)}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+
+        self.__head: bytes = head
+        self.__tail: bytes = f"\r\n--{boundary}--\r\n".encode()
+        self.__content: bytes | AsyncIterable[bytes] = content
+        self.headers: dict[str, str] = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(self.__head) + length + len(self.__tail)),
+        }
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self.__head
+        if isinstance(self.__content, bytes):
+            yield self.__content
+        else:
+            async for chunk in self.__content:
+                yield chunk
+        yield self.__tail
+
+
+# Escape name in content disposition as browsers do.
+def _quote(value: str) -> str:
+    for char, escaped in (("\\", "\\\\"), ('"', "%22"), ("\r", "%0D"), ("\n", "%0A")):
+        value = value.replace(char, escaped)
+    return value
@@ -1,50 +1,225 @@
 from PIL import Image, ImageFile
 from typing import AsyncIterator
-import httpx
+import httpclient
 import io
 from contextlib import asynccontextmanager
+from dataclasses import dataclass, replace
 import numpy
 import cv2
 import base64
+import math
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
 
 @asynccontextmanager
 async def open_remote_image(url: str) -> AsyncIterator[ImageFile.ImageFile]:
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url)
-        resp.content
-
-        f = Image.open(io.BytesIO(resp.content))
-
-        try:
-            yield f
-        finally:
-            f.close()
-
-
-def keep_ratio_stretch_to_height(src: Image.Image, h: int = 1080) -> Image.Image:
-    ipt = numpy.array(src)
+    client = httpclient.get(httpclient.Profile.download)
+    resp = await client.get(url)
+
+    f = Image.open(io.BytesIO(resp.content))
+
+    try:
+        yield f
+    finally:
+        f.close()
 
-    wh_ratio = src.width / src.height
-    w = int(h * wh_ratio)
 
-    res = cv2.resize(ipt, (w, h), interpolation=cv2.INTER_CUBIC)
-
-    return Image.fromarray(res)
+# Read whole body of remote file, decode it in a thread later.
+async def read_remote(url: str) -> bytes:
+    client = httpclient.get(httpclient.Profile.download)
+    resp = await client.get(url)
+    resp.raise_for_status()
+    return resp.content
+
+
+def is_png(data: bytes) -> bool:
+    return data.startswith(PNG_SIGNATURE)
+
+
+# Decode image to array, keep source mode if mode is None.
+# JPEG much larger than height h decoded at reduced size by decoder,
+# result still at least h pixels height.
+def decode(
+    data: bytes, mode: str | None = "RGB", h: int | None = None
+) -> numpy.ndarray:
+    with Image.open(io.BytesIO(data)) as img:
+        if h is not None and img.height >= 2 * h:
+            img.draft(mode, (math.ceil(img.width * h / img.height), h))
+        if mode is not None and img.mode != mode:
+            return numpy.asarray(img.convert(mode))
+        return numpy.asarray(img)
+
+
+# Scale src to height h keep ratio and put it at center of a w x h white
+# canvas in a single resize, part wider than canvas is cropped.
+def letterbox(src: numpy.ndarray, w: int = 1920, h: int = 1080) -> numpy.ndarray:
+    sh, sw = src.shape[:2]
+    scaled = int(h * sw / sh)
+    canvas = numpy.empty((h, w) + src.shape[2:], dtype=numpy.uint8)
+
+    if scaled <= w:
+        x = (w - scaled) // 2
+        canvas[:, :x] = 255
+        canvas[:, x + scaled :] = 255
+        src_part, dst = src, canvas[:, x : x + scaled]
+    else:
+        # Crop source first, never scale pixels thrown away.
+        x = (scaled - w + 1) // 2
+        left = int(x * sw / scaled)
+        right = min(sw, math.ceil((x + w) * sw / scaled))
+        src_part, dst = src[:, left:right], canvas
+
+    interpolation = cv2.INTER_AREA if scaled < sw else cv2.INTER_CUBIC
+    cv2.resize(
+        src_part, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=interpolation
+    )
+    return canvas
+
+
+def load_letterboxed(data: bytes, w: int = 1920, h: int = 1080) -> numpy.ndarray:
+    return letterbox(decode(data, h=h), w, h)
+
+
+def invert(src: numpy.ndarray) -> numpy.ndarray:
+    return cv2.bitwise_not(src)
+
+
+def load_inverted(data: bytes) -> numpy.ndarray:
+    return invert(decode(data, mode=None))
+
+
+# How image encoded before send to inference backend.
+# quality used by jpeg and lossy webp, compress_level by png, 0 - 9.
+# fast encode png by opencv, about twice faster than pillow in same size,
+# and webp lossless with least effort.
+@dataclass(frozen=True)
+class Encoding:
+    format: str = "png"
+    quality: int = 90
+    compress_level: int = 3
+    lossless: bool = False
+    fast: bool = True
+
+    @property
+    def is_lossless(self) -> bool:
+        return self.format == "png" or (self.format == "webp" and self.lossless)
+
+    # Same key means backend receive same pixels, lossless encodings all same.
+    @property
+    def key(self) -> str:
+        if self.is_lossless:
+            return "lossless"
+        return f"{self.format}-q{self.quality}"
+
+    # Mask edges must stay exact, lossy format fall back to png.
+    def for_mask(self) -> "Encoding":
+        if self.is_lossless:
+            return self
+        return replace(self, format="png")
+
+
+PNG = Encoding(fast=False, compress_level=6)
+
+
+def encode(img: numpy.ndarray, encoding: Encoding | str = PNG) -> bytes:
+    if isinstance(encoding, str):
+        encoding = replace(PNG, format=encoding)
+
+    match encoding.format:
+        case "png" if encoding.fast:
+            if img.ndim == 3 and img.shape[2] == 3:
+                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            elif img.ndim == 3 and img.shape[2] == 4:
+                img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA)
+            ok, buf = cv2.imencode(
+                ".png", img, [cv2.IMWRITE_PNG_COMPRESSION, encoding.compress_level]
+            )
+            if not ok:
+                raise ValueError("encode png failed")
+            return buf.tobytes()
+        case "png":
+            args = {"compress_level": encoding.compress_level}
+        case "jpeg":
+            args = {"quality": encoding.quality}
+        case "webp" if encoding.lossless:
+            args = {"lossless": True, "method": 0 if encoding.fast else 4}
+        case "webp":
+            args = {"quality": encoding.quality}
+        case _:
+            raise ValueError(f"unsupported image encoding {encoding.format}")
 
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format=encoding.format, **args)
+    return buf.getvalue()
 
-def resize(src: Image.Image, w: int = 1920, h: int = 1080) -> Image.Image:
-    new_image = Image.new("RGB", (w, h), (255, 255, 255))
 
-    x = (w - src.width) // 2
-    y = (h - src.height) // 2
+def array_to_b64(img: numpy.ndarray, encoding: Encoding | str = PNG) -> bytes:
+    return base64.b64encode(encode(img, encoding))
 
-    new_image.paste(src, (x, y))
 
-    return new_image
+# Keep png as is, decode and encode others.
+def to_png(data: bytes) -> bytes:
+    if is_png(data):
+        return data
+    return encode(decode(data, mode=None), "png")
 
 
 def image_to_b64(img: Image.Image, format: str = "png") -> bytes:
     buf = io.BytesIO()
     img.save(buf, format=format)
     return base64.b64encode(buf.getvalue())
+
+
+# Compare encode time and payload size of encodings on 1080p input:
+# python imglib.py [image ...], synthetic photo and mask if no image given.
+if __name__ == "__main__":
+    import sys
+    import time
+
+    def synthetic() -> list[tuple[str, numpy.ndarray]]:
+        rng = numpy.random.default_rng(0)
+        small = rng.integers(0, 255, (60, 80, 3), dtype=numpy.uint8)
+        photo = cv2.resize(small, (1440, 1080), interpolation=cv2.INTER_CUBIC)
+        noise = rng.normal(0, 6, photo.shape)
+        photo = numpy.clip(photo + noise, 0, 255).astype(numpy.uint8)
+        mask = numpy.zeros((1080, 1920), dtype=numpy.uint8)
+        cv2.circle(mask, (960, 540), 400, 255, -1)
+        return [("photo", letterbox(photo)), ("mask", mask)]
+
+    inputs = [
+        (path, load_letterboxed(open(path, "rb").read())) for path in sys.argv[1:]
+    ] or synthetic()
+
+    def label(enc: Encoding) -> str:
+        if enc.format == "png":
+            option = f"level {enc.compress_level}"
+        elif enc.is_lossless:
+            option = "lossless"
+        else:
+            option = f"quality {enc.quality}"
+        return f"{enc.format} {option}{' fast' if enc.fast and enc.is_lossless else ''}"
+
+    encodings = [
+        PNG,
+        Encoding(fast=False, compress_level=1),
+        Encoding(compress_level=1),
+        Encoding(),
+        Encoding("jpeg", quality=90),
+        Encoding("jpeg", quality=80),
+        Encoding("webp", quality=90, fast=False),
+        Encoding("webp", lossless=True),
+    ]
+
+    for name, img in inputs:
+        print(f"{name} {img.shape[1]}x{img.shape[0]}, raw {img.nbytes >> 10} KiB")
+        for enc in encodings:
+            if img.ndim == 2:
+                enc = enc.for_mask()
+            encode(img, enc)
+            rounds = 3
+            started = time.perf_counter()
+            for _ in range(rounds):
+                size = len(encode(img, enc))
+            elapsed = (time.perf_counter() - started) / rounds
+            print(f"  {label(enc):24} {elapsed * 1000:7.1f} ms {size >> 10:7} KiB")
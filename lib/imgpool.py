@@ -0,0 +1,165 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Iterator, TypeVar
+
+import numpy
+from loguru import logger
+
+import imglib
+
+T = TypeVar("T")
+
+_workers: int = 2
+_max_pending: int = 8
+
+_pool: ProcessPoolExecutor | None = None
+_slots: asyncio.Semaphore | None = None
+
+
+async def init(workers: int = 2, max_pending: int = 8) -> None:
+    global _workers
+    global _max_pending
+    global _slots
+
+    await close()
+    _workers = workers
+    _max_pending = max_pending
+    _slots = None
+
+
+async def close() -> None:
+    global _pool
+
+    pool, _pool = _pool, None
+    if pool is not None:
+        await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+
+def _get() -> tuple[ProcessPoolExecutor, asyncio.Semaphore]:
+    global _pool
+    global _slots
+
+    # Spawn, never fork a process already running event loop and threads.
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            _workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+    if _slots is None:
+        _slots = asyncio.Semaphore(_max_pending)
+    return _pool, _slots
+
+
+# Run fn in image worker process, wait here when too many jobs pending,
+# so a burst of jobs queue on event loop instead of eat all memory.
+async def run(fn: Callable[..., T], *args: Any) -> T:
+    global _pool
+
+    pool, slots = _get()
+    async with slots:
+        try:
+            fut = pool.submit(fn, *args)
+            try:
+                return await asyncio.wrap_future(fut)
+            except asyncio.CancelledError:
+                # Job may already run, nobody take its result then.
+                fut.add_done_callback(_drop_result)
+                raise
+        except BrokenProcessPool:
+            # A worker died, create new pool for next job.
+            logger.error("image worker pool broken, restart it")
+            if _pool is pool:
+                _pool = None
+            raise
+
+
+def _drop_result(fut: Future[Any]) -> None:
+    if fut.cancelled() or fut.exception() is not None:
+        return
+    result = fut.result()
+    if isinstance(result, SharedArray):
+        result.unlink()
+
+
+def _init_worker() -> None:
+    import cv2
+
+    # One job per process already, threads inside only fight each other.
+    cv2.setNumThreads(1)
+
+
+# Pixels in shared memory, only name and shape pass between processes.
+# Creator of last step own it, call unlink when no one need it.
+@dataclass(frozen=True)
+class SharedArray:
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+    @staticmethod
+    def create(src: numpy.ndarray) -> "SharedArray":
+        shm = SharedMemory(create=True, size=max(src.nbytes, 1))
+        try:
+            dst: numpy.ndarray = numpy.ndarray(src.shape, src.dtype, buffer=shm.buf)
+            dst[:] = src
+            del dst
+            # Owner unlink it, do not let tracker of this process remove it.
+            resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+            return SharedArray(shm.name, src.shape, src.dtype.str)
+        finally:
+            shm.close()
+
+    @contextmanager
+    def open(self) -> Iterator[numpy.ndarray]:
+        shm = _attach(self.name)
+        try:
+            arr: numpy.ndarray = numpy.ndarray(
+                self.shape, numpy.dtype(self.dtype), buffer=shm.buf
+            )
+            try:
+                yield arr
+            finally:
+                del arr
+        finally:
+            shm.close()
+
+    def unlink(self) -> None:
+        try:
+            shm = SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def _attach(name: str) -> SharedMemory:
+    shm = SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+    return shm
+
+
+# Jobs run in worker processes, module level so they can be pickled.
+
+
+def letterbox(data: bytes, w: int = 1920, h: int = 1080) -> SharedArray:
+    return SharedArray.create(imglib.load_letterboxed(data, w, h))
+
+
+def load_inverted(data: bytes) -> SharedArray:
+    return SharedArray.create(imglib.load_inverted(data))
+
+
+def to_b64(img: SharedArray, encoding: imglib.Encoding = imglib.PNG) -> bytes:
+    with img.open() as arr:
+        return imglib.array_to_b64(arr, encoding)
+
+
+def to_png(data: bytes) -> bytes:
+    return imglib.to_png(data)
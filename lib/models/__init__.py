@@ -3,6 +3,8 @@ from . import inferences
 from . import logs
 from . import system_config
 from . import session
+from . import outbox
+from . import image_cache
 
 
 async def init(db: AsyncDatabase) -> None:
@@ -19,3 +21,5 @@ async def init(db: AsyncDatabase) -> None:
     await logs.init(db)
     await system_config.init(db)
     await session.init(db)
+    await outbox.init(db)
+    await image_cache.init(db)
@@ -0,0 +1,131 @@
+from beanie import Document, UpdateResponse
+from beanie.operators import Set
+from enum import StrEnum
+import asyncio
+from datetime import datetime, timedelta
+from loguru import logger
+from pydantic import Field
+from pymongo import ASCENDING, IndexModel
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import DuplicateKeyError
+from typing import Self
+import oss
+
+# Entry not hit in this time removed, and least recently hit removed first
+# when total size of owned files over MAX_BYTES.
+TTL = timedelta(days=7)
+MAX_BYTES = 2 * 1024**3
+EVICT_INTERVAL = 600
+
+
+async def init(db: AsyncDatabase) -> None:
+    from beanie import init_beanie
+
+    await init_beanie(db, document_models=[Entry])
+
+
+class Kind(StrEnum):
+    # Background mask segment_any give for source picture.
+    mask = "mask"
+    # Normalized picture replace_with_any give for source picture.
+    normalized = "normalized"
+
+
+# Result of image pipeline for a source picture, found by hash of source
+# bytes and version of pipeline step produce it. File in oss removed with
+# entry if owned, others still referenced by tasks and stay.
+class Entry(Document):
+    kind: Kind
+    sha256: str
+    version: str
+    fid: str
+    size: int
+    owned: bool = True
+    ctime: datetime = Field(default_factory=datetime.now)
+    atime: datetime = Field(default_factory=datetime.now)
+
+    class Settings:
+        name = "image_cache"
+        indexes = [
+            IndexModel(
+                [("kind", ASCENDING), ("sha256", ASCENDING), ("version", ASCENDING)],
+                name="kind_sha256_version",
+                unique=True,
+            ),
+            IndexModel("atime"),
+            IndexModel([("owned", ASCENDING), ("atime", ASCENDING)]),
+        ]
+
+    # Find entry and mark it used now.
+    @classmethod
+    async def lookup(cls, kind: Kind, sha256: str, version: str) -> Self | None:
+        return await cls.find_one(
+            cls.kind == kind, cls.sha256 == sha256, cls.version == version
+        ).update(
+            Set({cls.atime: datetime.now()}),
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+
+    # Same result may be put by concurrent tasks, first one kept.
+    @classmethod
+    async def put(
+        cls,
+        kind: Kind,
+        sha256: str,
+        version: str,
+        fid: str,
+        size: int,
+        owned: bool = True,
+    ) -> None:
+        entry = cls(
+            kind=kind, sha256=sha256, version=version, fid=fid, size=size, owned=owned
+        )
+        try:
+            await entry.insert()
+        except DuplicateKeyError:
+            if owned:
+                await oss.delete_file(fid)
+
+    # Only owned files count in size, remove others free nothing.
+    @classmethod
+    async def evict(cls, ttl: timedelta = TTL, max_bytes: int = MAX_BYTES) -> None:
+        async for entry in cls.find(cls.atime < datetime.now() - ttl):
+            await entry.remove()
+
+        result = (
+            await cls.find(cls.owned == True)
+            .aggregate([{"$group": {"_id": None, "size": {"$sum": "$size"}}}])
+            .to_list()
+        )
+        total = result[0]["size"] if result else 0
+        if total <= max_bytes:
+            return
+
+        async for entry in cls.find(cls.owned == True).sort(+cls.atime):
+            if total <= max_bytes:
+                break
+            await entry.remove()
+            total -= entry.size
+
+    # Delete entry before its file, so no lookup find a removed file.
+    # Entry removed by other process at same time, leave file to it.
+    async def remove(self) -> None:
+        result = await self.delete()
+        if result is not None and result.deleted_count == 0:
+            return
+        if self.owned:
+            try:
+                await oss.delete_file(self.fid)
+            except Exception as exc:
+                logger.warning(f"delete cached file {self.fid} error: {repr(exc)}")
+
+
+async def evict_forever(interval: float = EVICT_INTERVAL) -> None:
+    while True:
+        try:
+            await Entry.evict()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.error(f"evict image cache error: {repr(exc)}")
+        await asyncio.sleep(interval)
@@ -1,13 +1,15 @@
 from enum import StrEnum
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from pydantic import Field
 from .. import users
-from beanie import Document
+from beanie import Document, PydanticObjectId, UpdateResponse
+from beanie.operators import In, Inc, Pull, Push, Set
+from pymongo import ASCENDING, IndexModel
 
 from .models import *
 
-from typing import Sequence
+from typing import Any, Mapping, Self, Sequence
 
 
 class Gender(StrEnum):
@@ -33,27 +35,205 @@ class Inference(Document):
     ctime: datetime = Field(default_factory=datetime.now)
     utime: datetime = Field(default_factory=datetime.now)
 
+    # Set when claimed, task belongs to worker until lease expired.
+    worker: str | None = None
+    lease_until: datetime | None = None
+    attempts: int = 0
+
     class Settings:
         name = "inferences"
         is_root = True
         class_id = "type"
+        indexes = [
+            IndexModel(
+                [("state", ASCENDING), ("type", ASCENDING), ("ctime", ASCENDING)]
+            )
+        ]
+
+    # Move oldest waiting task of this class to processing in one operation,
+    # so each task claimed by only one worker, none if no waiting task.
+    # Claim the given task only if id given, none if it is not waiting any more.
+    @classmethod
+    async def claim(
+        cls, worker: str, lease: timedelta, id: PydanticObjectId | None = None
+    ) -> Self | None:
+        now = datetime.now()
+        query = cls.find_one(cls.state == State.waiting)
+        if id is not None:
+            query = cls.find_one(cls.id == id, cls.state == State.waiting)
+        return await query.update(
+            Set(
+                {
+                    cls.state: State.processing,
+                    cls.worker: worker,
+                    cls.lease_until: now + lease,
+                    cls.utime: now,
+                }
+            ),
+            Inc({cls.attempts: 1}),
+            response_type=UpdateResponse.NEW_DOCUMENT,
+            sort=[("ctime", ASCENDING)],
+        )
+
+    # Id and create time of waiting tasks of this class, at most limit oldest
+    # of each user, group by user.
+    @classmethod
+    async def waiting_by_user(
+        cls, limit: int
+    ) -> dict[tuple[str, str], list[tuple[PydanticObjectId, datetime]]]:
+        pipeline: list[dict[str, Any]] = [
+            {"$sort": {"ctime": ASCENDING}},
+            {
+                "$group": {
+                    "_id": "$uid",
+                    "tasks": {"$push": {"id": "$_id", "ctime": "$ctime"}},
+                }
+            },
+            {"$project": {"tasks": {"$slice": ["$tasks", limit]}}},
+        ]
+        groups = (
+            await cls.find(cls.state == State.waiting).aggregate(pipeline).to_list()
+        )
+        return {
+            (g["_id"]["source"], g["_id"]["ident"]): [
+                (t["id"], t["ctime"]) for t in g["tasks"]
+            ]
+            for g in groups
+        }
+
+    # Count of processing tasks of this class of each user, all workers.
+    @classmethod
+    async def running_by_user(cls) -> dict[tuple[str, str], int]:
+        pipeline: list[dict[str, Any]] = [
+            {"$group": {"_id": "$uid", "count": {"$sum": 1}}}
+        ]
+        groups = (
+            await cls.find(cls.state == State.processing).aggregate(pipeline).to_list()
+        )
+        return {(g["_id"]["source"], g["_id"]["ident"]): g["count"] for g in groups}
+
+    # Extend lease of tasks still processing by worker in one update.
+    @classmethod
+    async def renew_leases(
+        cls, ids: Sequence[PydanticObjectId], worker: str, lease: timedelta
+    ) -> None:
+        await cls.find(
+            In(cls.id, list(ids)),
+            cls.worker == worker,
+            cls.state == State.processing,
+            with_children=True,
+        ).update(Set({cls.lease_until: datetime.now() + lease}))
+
+    # Worker give up task itself, put it back without count an attempt.
+    async def release(self, worker: str) -> None:
+        await Inference.find_one(
+            Inference.id == self.id,
+            Inference.worker == worker,
+            Inference.state == State.processing,
+            with_children=True,
+        ).update(
+            Set(
+                {
+                    Inference.state: State.waiting,
+                    Inference.worker: None,
+                    Inference.lease_until: None,
+                    Inference.utime: datetime.now(),
+                }
+            ),
+            Inc({Inference.attempts: -1}),
+        )
+
+    # Set final state only if task still processing by worker, its lease may
+    # expire and task given to others meanwhile. Return whether set, task
+    # synced with stored one if set.
+    async def finish(
+        self, worker: str, state: State, fields: Mapping[Any, Any] | None = None
+    ) -> bool:
+        values: dict[Any, Any] = {
+            Inference.state: state,
+            Inference.lease_until: None,
+            Inference.utime: datetime.now(),
+        }
+        values.update(fields or {})
+
+        task = await Inference.find_one(
+            Inference.id == self.id,
+            Inference.worker == worker,
+            Inference.state == State.processing,
+            with_children=True,
+        ).update(Set(values), response_type=UpdateResponse.NEW_DOCUMENT)
+        if task is None:
+            return False
+
+        for name in type(self).model_fields:
+            setattr(self, name, getattr(task, name))
+        return True
+
+    # Filter of processing tasks whose worker lost, tasks claimed before
+    # lease exists treat as expired when not updated in legacy timeout.
+    @staticmethod
+    def _expired(legacy_timeout: timedelta) -> dict[str, Any]:
+        now = datetime.now()
+        return {
+            "state": State.processing,
+            "$or": [
+                {"lease_until": {"$lt": now}},
+                {"lease_until": None, "utime": {"$lt": now - legacy_timeout}},
+            ],
+        }
+
+    # Put one expired task back to waiting, if it not tried max attempts.
+    @classmethod
+    async def requeue_expired(
+        cls, max_attempts: int, legacy_timeout: timedelta
+    ) -> "Inference | None":
+        query = cls._expired(legacy_timeout)
+        query["attempts"] = {"$not": {"$gte": max_attempts}}
+        return await cls.find_one(query, with_children=True).update(
+            Set(
+                {
+                    cls.state: State.waiting,
+                    cls.worker: None,
+                    cls.lease_until: None,
+                    cls.utime: datetime.now(),
+                }
+            ),
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
+
+    # Set one expired task which tried max attempts to error, response of
+    # all task classes have code and msg.
+    @classmethod
+    async def fail_expired(
+        cls, max_attempts: int, legacy_timeout: timedelta, msg: str
+    ) -> "Inference | None":
+        query = cls._expired(legacy_timeout)
+        query["attempts"] = {"$gte": max_attempts}
+        return await cls.find_one(query, with_children=True).update(
+            Set(
+                {
+                    cls.state: State.error,
+                    cls.worker: None,
+                    cls.lease_until: None,
+                    cls.utime: datetime.now(),
+                    "response": {"code": 1, "msg": msg},
+                }
+            ),
+            response_type=UpdateResponse.NEW_DOCUMENT,
+        )
 
 
 class StandardTask(Inference):
     request: Request
     response: StandardResponse | None = None
 
-    async def set_success(self, url: str) -> None:
-        self.response = StandardResponse(data=url)
-        self.utime = datetime.now()
-        self.state = State.down
-        await self.save()
+    async def set_success(self, worker: str, url: str) -> bool:
+        response = StandardResponse(data=url)
+        return await self.finish(worker, State.down, {"response": response})
 
-    async def set_error(self, code: int, msg: str) -> None:
-        self.response = StandardResponse(code=code, msg=msg)
-        self.utime = datetime.now()
-        self.state = State.error
-        await self.save()
+    async def set_error(self, worker: str, code: int, msg: str) -> bool:
+        response = StandardResponse(code=code, msg=msg)
+        return await self.finish(worker, State.error, {"response": response})
 
 
 class HeavenAlbum(Inference):
@@ -72,23 +252,39 @@ class HeavenAlbum(Inference):
     norimalized_picture: str | None = None
     response: CompositeResponse | None = None
 
+    # Data updated in place so parallel results never overwrite each other,
+    # size slots reserved when result need keep same order with prompts.
+    async def init_data(self, size: int = 0) -> None:
+        await self.set(
+            {
+                HeavenAlbum.response: CompositeResponse(data=[""] * size),
+                HeavenAlbum.utime: datetime.now(),
+            }
+        )
+
+    async def set_data(self, index: int, data: str) -> None:
+        await self.set(
+            {f"response.data.{index}": data, HeavenAlbum.utime: datetime.now()}
+        )
+
     async def add_data(self, data: str) -> None:
         if not self.response:
-            self.response = CompositeResponse()
-        self.response.data.append(data)
-        self.utime = datetime.now()
-        await self.save()
+            await self.init_data()
+        await self.update(
+            Push({"response.data": data}), Set({HeavenAlbum.utime: datetime.now()})
+        )
 
-    async def set_success(self) -> None:
-        self.utime = datetime.now()
-        self.state = State.down
-        await self.save()
+    # Remove slots reserved but no result set.
+    async def compact_data(self) -> None:
+        await self.update(Pull({"response.data": ""}))
 
-    async def set_error(self, code: int, msg: str) -> None:
-        self.response = CompositeResponse(code=code, msg=msg)
-        self.utime = datetime.now()
-        self.state = State.error
-        await self.save()
+    # Only set state, data already added in place.
+    async def set_success(self, worker: str) -> bool:
+        return await self.finish(worker, State.down)
+
+    async def set_error(self, worker: str, code: int, msg: str) -> bool:
+        response = CompositeResponse(code=code, msg=msg)
+        return await self.finish(worker, State.error, {"response": response})
 
     async def set_ready(self) -> None:
         self.utime = datetime.now()
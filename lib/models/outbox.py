@@ -0,0 +1,123 @@
+from beanie import Document, UpdateResponse
+from beanie.operators import Inc, Set
+from enum import StrEnum
+from datetime import datetime, timedelta
+from pydantic import Field
+from pymongo import ASCENDING, IndexModel
+from pymongo.asynchronous.database import AsyncDatabase
+from typing import Any, Self, Sequence
+from urllib.parse import urlsplit
+
+
+async def init(db: AsyncDatabase) -> None:
+    from beanie import init_beanie
+
+    await init_beanie(db, document_models=[Callback])
+
+
+class State(StrEnum):
+    pending = "pending"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+
+
+# Task callback waiting to deliver, dispatcher only write it here,
+# senders deliver it with retries.
+class Callback(Document):
+    url: str
+    target: str
+    payload: dict[str, Any]
+    state: State = State.pending
+    attempts: int = 0
+    next_try: datetime = Field(default_factory=datetime.now)
+    worker: str | None = None
+    lease_until: datetime | None = None
+    error: str | None = None
+    ctime: datetime = Field(default_factory=datetime.now)
+    # Set when delivered or given up, document removed some days after.
+    done_time: datetime | None = None
+
+    class Settings:
+        name = "callback_outbox"
+        indexes = [
+            IndexModel(
+                [("state", ASCENDING), ("next_try", ASCENDING)],
+                name="state_next_try",
+            ),
+            IndexModel("done_time", expireAfterSeconds=7 * 24 * 3600),
+        ]
+
+    @classmethod
+    async def enqueue(cls, url: str, payload: dict[str, Any]) -> Self:
+        cb = cls(url=url, target=urlsplit(url).netloc, payload=payload)
+        await cb.insert()
+        return cb
+
+    # Claim the earliest callback due, skip targets already busy.
+    # Callback of dead sender can be claimed again after lease expired.
+    @classmethod
+    async def claim(
+        cls, worker: str, lease: timedelta, busy: Sequence[str] = ()
+    ) -> Self | None:
+        now = datetime.now()
+        return await cls.find_one(
+            {
+                "$or": [
+                    {"state": State.pending, "next_try": {"$lte": now}},
+                    {"state": State.sending, "lease_until": {"$lt": now}},
+                ],
+                "target": {"$nin": list(busy)},
+            }
+        ).update(
+            Set(
+                {
+                    cls.state: State.sending,
+                    cls.worker: worker,
+                    cls.lease_until: now + lease,
+                }
+            ),
+            Inc({cls.attempts: 1}),
+            response_type=UpdateResponse.NEW_DOCUMENT,
+            sort=[("next_try", ASCENDING)],
+        )
+
+    async def set_sent(self) -> None:
+        await self.update(
+            Set(
+                {
+                    Callback.state: State.sent,
+                    Callback.error: None,
+                    Callback.done_time: datetime.now(),
+                }
+            )
+        )
+
+    async def set_retry(self, error: str, delay: timedelta) -> None:
+        await self.update(
+            Set(
+                {
+                    Callback.state: State.pending,
+                    Callback.error: error,
+                    Callback.next_try: datetime.now() + delay,
+                }
+            )
+        )
+
+    async def set_failed(self, error: str) -> None:
+        await self.update(
+            Set(
+                {
+                    Callback.state: State.failed,
+                    Callback.error: error,
+                    Callback.done_time: datetime.now(),
+                }
+            )
+        )
+
+    # Sender stopped before deliver, give it back without count an attempt.
+    async def release(self) -> None:
+        await self.update(
+            Set({Callback.state: State.pending, Callback.next_try: datetime.now()}),
+            Inc({Callback.attempts: -1}),
+        )
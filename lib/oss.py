@@ -1,7 +1,7 @@
 import gridfs
 from beanie import PydanticObjectId
 from pymongo.asynchronous.database import AsyncDatabase
-from typing import BinaryIO, AsyncIterator, Any
+from typing import BinaryIO, AsyncIterator, Any, Mapping
 from contextlib import asynccontextmanager
 
 
@@ -11,6 +11,7 @@ __fs: gridfs.AsyncGridFS | None = None
 async def init(db: AsyncDatabase) -> None:
     global __fs
     __fs = gridfs.AsyncGridFS(db)
+    await db["fs.files"].create_index("metadata.sha256", sparse=True)
 
 
 def is_inited() -> bool:
@@ -56,12 +57,19 @@ class OssReader:
     async def read(self, size: int = -1) -> bytes:
         return await self.__out.read(size)
 
+    # Content by chunks as stored, iterate reader itself split it by lines.
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while chunk := await self.__out.readchunk():
+            yield chunk
+
     def __aiter__(self) -> Any:
         return self.__out
 
 
 @asynccontextmanager
-async def save_file(filename: str, content_type: str) -> AsyncIterator[OssWriter]:
+async def save_file(
+    filename: str, content_type: str, metadata: Mapping[str, Any] | None = None
+) -> AsyncIterator[OssWriter]:
     if not __fs:
         raise ValueError("must init oss first")
 
@@ -71,6 +79,23 @@ async def save_file(filename: str, content_type: str) -> AsyncIterator[OssWriter
         finally:
             writer.content_type = content_type
             await writer.set("filename", filename)
+            if metadata:
+                await writer.set("metadata", dict(metadata))
+
+
+# Find a file which metadata match all given fields, return file id if have.
+async def find_file(metadata: Mapping[str, Any]) -> str | None:
+    if not __fs:
+        raise ValueError("must init oss first")
+
+    fp = await __fs.find_one({f"metadata.{k}": v for k, v in metadata.items()})
+    if not fp:
+        return None
+
+    try:
+        return str(fp._id)
+    finally:
+        await fp.close()
 
 
 @asynccontextmanager
@@ -83,3 +108,10 @@ async def load_file(fid: str) -> AsyncIterator[OssReader]:
         yield OssReader(fp)
     finally:
         await fp.close()
+
+
+async def delete_file(fid: str) -> None:
+    if not __fs:
+        raise ValueError("must init oss first")
+
+    await __fs.delete(PydanticObjectId(fid))
@@ -1,7 +1,9 @@
 from datetime import datetime
+from enum import StrEnum
+from typing import Literal
 from beanie import Document, UnionDoc
 import pymongo
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class SysConfig(UnionDoc):
@@ -63,10 +65,39 @@ class InferenceEndpoint(BaseModel):
     edit_with_prompt: str
 
 
+# Encoding of images send to an endpoint, see imglib.Encoding.
+class ImageEncoding(BaseModel):
+    format: Literal["png", "jpeg", "webp"] = "png"
+    quality: int = Field(default=90, ge=1, le=100)
+    compress_level: int = Field(default=3, ge=0, le=9)
+    lossless: bool = False
+    fast: bool = True
+
+
+# How dispatcher send image to an endpoint. json put base64 image in
+# init_image. multipart send image as init_image file part and other
+# fields as form fields. raw send image as whole body, other fields as
+# query params.
+class RequestMode(StrEnum):
+    json = "json"
+    multipart = "multipart"
+    raw = "raw"
+
+
 class InferenceConfig(Document):
     service_host: str
     endpoints: InferenceEndpoint
 
+    # More hosts serve same endpoints as service host.
+    backends: list[str] = []
+
+    # Image encoding of endpoint path, such as /segment_any,
+    # endpoint not in it use fast png.
+    image_encodings: dict[str, ImageEncoding] = {}
+
+    # Request mode of endpoint path, endpoint not in it use json.
+    request_modes: dict[str, RequestMode] = {}
+
     class Settings:
         name = "inference"
         union_doc = SysConfig
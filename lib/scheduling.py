@@ -0,0 +1,33 @@
+from datetime import datetime
+from typing import Hashable, Mapping, Sequence, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+
+
+# Weighted round robin between users of one lane, pick next item from user
+# have least running items relative to weight, oldest head first if tie.
+# Queues hold items of each user oldest first, with their create time.
+def weighted_round_robin(
+    queues: Mapping[K, Sequence[tuple[T, datetime]]],
+    running: Mapping[K, int],
+    weights: Mapping[K, float],
+    limit: int,
+) -> list[T]:
+    heads = {k: 0 for k, q in queues.items() if len(q) != 0}
+    counts = {k: running.get(k, 0) for k in heads}
+
+    picked: list[T] = []
+    while len(picked) < limit and heads:
+        user = min(
+            heads,
+            key=lambda k: (counts[k] / weights.get(k, 1), queues[k][heads[k]][1]),
+        )
+        picked.append(queues[user][heads[user]][0])
+        counts[user] += 1
+
+        heads[user] += 1
+        if heads[user] == len(queues[user]):
+            del heads[user]
+
+    return picked
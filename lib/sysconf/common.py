@@ -1,53 +1,54 @@
-from sqlalchemy import Engine
-from sqlmodel import Session, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from database.config import SystemConfigCategory as Category, SystemConfig
 
 
 class SysConf:
 
-    def __init__(self, db: Engine) -> None:
-        self._db: Engine = db
+    def __init__(self, db: AsyncEngine) -> None:
+        self._db: AsyncEngine = db
 
-    def get(self, category: Category, name: str) -> str | None:
+    async def get(self, category: Category, name: str) -> str | None:
         query = (
             select(SystemConfig)
             .where(SystemConfig.category == category)
             .where(SystemConfig.name == name)
         )
 
-        with Session(self._db) as ses:
-            conf = ses.exec(query).one_or_none()
+        async with AsyncSession(self._db) as ses:
+            conf = (await ses.exec(query)).one_or_none()
             if conf:
                 return conf.value
             else:
                 return None
 
-    def set(self, category: Category, name: str, value: str) -> None:
+    async def set(self, category: Category, name: str, value: str) -> None:
         query = (
             select(SystemConfig)
             .where(SystemConfig.category == category)
             .where(SystemConfig.name == name)
         )
 
-        with Session(self._db) as ses:
-            conf = ses.exec(query).one_or_none()
+        async with AsyncSession(self._db) as ses:
+            conf = (await ses.exec(query)).one_or_none()
             if not conf:
                 conf = SystemConfig(category=category, name=name, value=value)
             else:
                 conf.value = value
 
             ses.add(conf)
-            ses.commit()
+            await ses.commit()
 
 
 class SysConfWithCategory:
 
-    def __init__(self, db: Engine, category: Category) -> None:
+    def __init__(self, db: AsyncEngine, category: Category) -> None:
         self._sysconf = SysConf(db)
         self._category = category
 
-    def get(self, name: str) -> str | None:
-        return self._sysconf.get(self._category, name)
+    async def get(self, name: str) -> str | None:
+        return await self._sysconf.get(self._category, name)
 
-    def set(self, name: str, value: str) -> None:
-        return self._sysconf.set(self._category, name, value)
+    async def set(self, name: str, value: str) -> None:
+        return await self._sysconf.set(self._category, name, value)
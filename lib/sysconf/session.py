@@ -1,6 +1,7 @@
 from database.config import SystemConfigCategory as Category, SystemConfig
-from sqlmodel import Session as DbSession, select
-from sqlalchemy import Engine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncEngine
 import json
 
 _DEFAULT_TTL = 3600
@@ -8,25 +9,19 @@ _DEFAULT_TTL = 3600
 
 class Session:
 
-    def __init__(self, db: Engine) -> None:
-        self._db: Engine = db
+    def __init__(self, db: AsyncEngine) -> None:
+        self._db: AsyncEngine = db
 
-    @property
-    def ttl(self) -> int:
-        with DbSession(self._db) as ses:
+    async def ttl(self) -> int:
+        async with AsyncSession(self._db) as ses:
             query = (
                 select(SystemConfig)
                 .where(SystemConfig.category == Category.session)
                 .where(SystemConfig.name == "ttl")
             )
-            conf = ses.exec(query).one_or_none()
+            conf = (await ses.exec(query)).one_or_none()
 
             if conf is None:
                 return _DEFAULT_TTL
 
             return json.loads(conf.value)["ttl_in_seconds"]
-
-    @ttl.setter
-    def ttl(self, t: int) -> None:
-        pass
-        
\ No newline at end of file
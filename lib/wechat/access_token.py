@@ -1,6 +1,7 @@
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 import httpx
+import httpclient
 from loguru import logger
 from persistence.sysconf import WechatConfig
 from abc import ABC, abstractmethod
@@ -43,10 +44,10 @@ class WxAccessToken:
         )
 
     async def async_refresh(self) -> None:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(self.__ENDPOINT, params=self.__params)
-            self.__token = WxAccessToken.Token.model_validate_json(resp.content)
-            self.__expires = datetime.now() + timedelta(seconds=self.__token.expires_in)
+        client = httpclient.get()
+        resp = await client.get(self.__ENDPOINT, params=self.__params)
+        self.__token = WxAccessToken.Token.model_validate_json(resp.content)
+        self.__expires = datetime.now() + timedelta(seconds=self.__token.expires_in)
 
     def __make_sure_token_valid(self) -> Token:
         if not self.__token:
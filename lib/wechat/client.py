@@ -2,7 +2,7 @@ from . import models, crypto
 import json
 import time
 from urllib.parse import quote_plus
-import httpx
+import httpclient
 from sysconf.wechat import Secrets
 
 
@@ -139,10 +139,9 @@ class WxClient:
         )
         auth_header.update(JSON_HEADER)
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.request(
-                "GET", url=WX_MAIN_HOST + url, content=body, headers=auth_header
-            )
+        resp = await httpclient.get().request(
+            "GET", url=WX_MAIN_HOST + url, content=body, headers=auth_header
+        )
 
         if verify:
             sign = resp.headers.get(WX_HEADER_SINGATURE)
@@ -187,10 +186,9 @@ class WxClient:
         )
         auth_header.update(JSON_HEADER)
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                url=WX_MAIN_HOST + url, content=body, headers=auth_header
-            )
+        resp = await httpclient.get().post(
+            url=WX_MAIN_HOST + url, content=body, headers=auth_header
+        )
 
         if verify:
             sign = resp.headers.get(WX_HEADER_SINGATURE)
@@ -239,8 +237,7 @@ class WxClient:
             "grant_type": "authorization_code",
         }
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(token_url, params=params)
+        resp = await httpclient.get().get(token_url, params=params)
         if resp.status_code == 200:
             return models.AccessToken.model_validate_json(resp.content)
 
@@ -251,8 +248,7 @@ class WxClient:
         url = "https://api.weixin.qq.com/sns/userinfo"
         params = {"access_token": access_token, "openid": openid}
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url, params=params)
+        resp = await httpclient.get().get(url, params=params)
         if resp.status_code == 200:
             return models.UserInfo.model_validate_json(resp.content)
 
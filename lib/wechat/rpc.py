@@ -1,5 +1,5 @@
 from .access_token import PersistenceWxAccessToken
-import httpx
+import httpclient
 from loguru import logger
 
 
@@ -14,16 +14,16 @@ class HeavenAlbum:
     async def update_task(
         self, tid: str, state: str, images: list[str] | None = None
     ) -> None:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                url=self.__INVOKE_FUNC_URL,
-                params={
-                    "access_token": await self.__access_token.token,
-                    "env": self.__env,
-                    "name": "aigc",
-                },
-                json={
-                    "func": "heaven_album:update_task",
-                    "params": {"tid": tid, "images": images, "state": state},
-                },
-            )
+        client = httpclient.get()
+        resp = await client.post(
+            url=self.__INVOKE_FUNC_URL,
+            params={
+                "access_token": await self.__access_token.token,
+                "env": self.__env,
+                "name": "aigc",
+            },
+            json={
+                "func": "heaven_album:update_task",
+                "params": {"tid": tid, "images": images, "state": state},
+            },
+        )
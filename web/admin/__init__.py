@@ -3,6 +3,7 @@ from pydantic import BaseModel
 from models import inferences
 from typing import Any
 from loguru import logger
+import backends
 
 webapp = FastAPI()
 
@@ -28,3 +29,9 @@ async def list_inference_task(offset: int, limit: int = 10):
     cnt = await inferences.Inference.find_all(with_children=True).count()
 
     return ListInferenceTaskResp(offset=offset, limit=limit, total=cnt, tasks=tasks)
+
+
+# Current in flight limits, latency and error rate of inference backends.
+@webapp.get("/inference/backends")
+async def list_inference_backends() -> list[dict[str, Any]]:
+    return backends.stats()
@@ -1,7 +1,7 @@
 import uvicorn
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from sqlmodel import SQLModel, create_engine
+from sqlmodel import create_engine
 from loguru import logger
 from threading import Thread
 from service import (
@@ -14,7 +14,9 @@ from service import (
 import persistence
 import models
 from pymongo import AsyncMongoClient
+import redis.asyncio
 import inference_dispatcher
+import callback_sender
 import asyncio
 import admin
 import ossapp
@@ -23,13 +25,26 @@ import dataio
 import rpcclient
 import wxproxy
 import oplog
+import database
+import httpclient
+import imgpool
+import backends
 
 
 async def main(conf: config.AppConfig) -> None:
 
-    # Setup database client.
+    # Setup database client, sync engine only for migration and refresh thread.
     db = create_engine(conf.db_url)
-    SQLModel.metadata.create_all(db)
+    database.migrate(db)
+    database.migration.explain_hot_queries(db)
+
+    adb = database.create_async_engine(
+        conf.db_url,
+        pool_size=conf.db_pool_size,
+        max_overflow=conf.db_max_overflow,
+        pool_timeout=conf.db_pool_timeout,
+        pool_recycle=conf.db_pool_recycle,
+    )
 
     # start refresh subscription.
     refresh_thread = Thread(
@@ -39,9 +54,12 @@ async def main(conf: config.AppConfig) -> None:
     )
     refresh_thread.start()
 
-    srv = infer_dispatch.Server(db)
-    dispatch_thread = Thread(target=srv.serve_forever, daemon=True)
-    dispatch_thread.start()
+    rdb = redis.asyncio.Redis(
+        host=conf.redis_host,
+        port=conf.redis_port,
+        db=conf.redis_db,
+        decode_responses=True,
+    )
 
     client = AsyncMongoClient(conf.mongodb_url)
     await persistence.init_presistence(client)
@@ -50,23 +68,52 @@ async def main(conf: config.AppConfig) -> None:
     await dataio.init(conf.mongodb_url)
     await oplog.init(conf.mongodb_url)
     await rpcclient.init("http://127.0.0.1:8090", rpcclient.Prefix())
+    await httpclient.init(
+        max_connections=conf.http_max_connections,
+        max_keepalive=conf.http_max_keepalive,
+        keepalive_expiry=conf.http_keepalive_expiry,
+        per_host=conf.http_per_host,
+        http2=conf.http2,
+    )
+    await imgpool.init(workers=conf.image_workers, max_pending=conf.image_queue)
 
     # Use app lifespan function to cleanup resource after shutdown.
     @asynccontextmanager
     async def lifespan(app: FastAPI):
-        app.state.db = db
+        app.state.db = adb
+        app.state.rdb = rdb
+        app.state.waiters = infer_dispatch.Waiters()
 
         disp = inference_dispatcher.Dispatcher()
         task = asyncio.create_task(disp.serve_forever())
+        sender = callback_sender.Sender()
+        sender_task = asyncio.create_task(sender.serve_forever())
+
+        srv = infer_dispatch.Server(adb, rdb, config.get_config().infer)
+        dispatch_task = asyncio.create_task(srv.serve_forever())
+        listen_task = asyncio.create_task(app.state.waiters.listen_forever(rdb))
+        health_task = asyncio.create_task(backends.check_forever())
+        evict_task = asyncio.create_task(models.image_cache.evict_forever())
 
         try:
             yield
         finally:
-            try:
-                task.cancel()
-                await task
-            except asyncio.CancelledError:
-                pass
+            # Dispatchers drain running tasks when cancelled, wait them together.
+            tasks = (
+                task,
+                sender_task,
+                dispatch_task,
+                listen_task,
+                health_task,
+                evict_task,
+            )
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await rdb.close()
+            await adb.dispose()
+            await httpclient.close()
+            await imgpool.close()
 
     if conf.refresh_mainpage:
         rc = mainpage_config.RemoteConfig(
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import random
+import socket
+from collections import defaultdict
+from datetime import timedelta
+
+import httpx
+from loguru import logger
+
+import httpclient
+from models import logs, outbox
+
+# Max callbacks send at same time, and to one target host.
+DEFAULT_CONCURRENCY = 16
+PER_TARGET_CONCURRENCY = 4
+
+# Whole delivery must complete in time, lease is longer so never expire
+# while sending.
+SEND_TIMEOUT = 30
+LEASE = 120
+
+# Retry after BACKOFF_BASE * 2^(attempts - 1) seconds with jitter, give up
+# after MAX_ATTEMPTS.
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+MAX_ATTEMPTS = 8
+
+POLL_INTERVAL = 1
+SHUTDOWN_GRACE = 10
+
+# Client errors never succeed on retry, except these.
+RETRY_STATUS = {408, 425, 429}
+
+
+def default_worker_name() -> str:
+    return f"callback-sender:{socket.gethostname()}:{os.getpid()}"
+
+
+def backoff(attempts: int) -> timedelta:
+    delay = min(BACKOFF_BASE * 2 ** max(attempts - 1, 0), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+class PermanentError(Exception):
+    pass
+
+
+class Sender:
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        per_target: int = PER_TARGET_CONCURRENCY,
+        worker: str | None = None,
+        grace: float = SHUTDOWN_GRACE,
+    ) -> None:
+        self._concurrency: int = concurrency
+        self._per_target: int = per_target
+        self._worker: str = worker if worker else default_worker_name()
+        self._lease: timedelta = timedelta(seconds=LEASE)
+        self._grace: float = grace
+
+        self._running: dict[str, int] = defaultdict(int)
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._wakeup: asyncio.Event = asyncio.Event()
+
+    async def serve_forever(self) -> None:
+        try:
+            while True:
+                try:
+                    self._wakeup.clear()
+                    await self.__fill()
+
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                    except TimeoutError:
+                        pass
+
+                except asyncio.CancelledError as e:
+                    raise e
+                except Exception as exc:
+                    logger.error(f"callback sender serve error: {repr(exc)}")
+                    await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            await self.__drain()
+
+    # Claim due callbacks until slots full, busy targets left to others.
+    async def __fill(self) -> None:
+        while len(self._tasks) < self._concurrency:
+            busy = [t for t, n in self._running.items() if n >= self._per_target]
+            cb = await outbox.Callback.claim(self._worker, self._lease, busy)
+            if cb is None:
+                return
+            self.__spawn(cb)
+
+    def __spawn(self, cb: outbox.Callback) -> None:
+        self._running[cb.target] += 1
+
+        async def run() -> None:
+            try:
+                await self.__deliver(cb)
+            except asyncio.CancelledError as e:
+                try:
+                    await cb.release()
+                except Exception as exc:
+                    logger.error(f"release callback {cb.id} error: {repr(exc)}")
+                raise e
+            except Exception as exc:
+                logger.error(f"deliver callback {cb.id} error: {repr(exc)}")
+            finally:
+                self._running[cb.target] -= 1
+                if self._running[cb.target] == 0:
+                    del self._running[cb.target]
+                self._wakeup.set()
+
+        t = asyncio.create_task(run())
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def __deliver(self, cb: outbox.Callback) -> None:
+        logger.debug(f"call task callback url {cb.url}, attempt {cb.attempts}")
+
+        try:
+            async with asyncio.timeout(SEND_TIMEOUT):
+                client = httpclient.get(httpclient.Profile.callback)
+                resp = await client.post(url=cb.url, json=cb.payload)
+            status = resp.status_code
+            if 400 <= status < 500 and status not in RETRY_STATUS:
+                raise PermanentError(f"status {status}")
+            resp.raise_for_status()
+
+        except PermanentError as exc:
+            await self.__give_up(cb, str(exc))
+        except (httpx.HTTPError, TimeoutError) as exc:
+            error = repr(exc)
+            if cb.attempts >= MAX_ATTEMPTS:
+                await self.__give_up(cb, error)
+            else:
+                delay = backoff(cb.attempts)
+                logger.warning(
+                    f"callback {cb.id} to {cb.url} failed: {error}, "
+                    f"retry in {delay.total_seconds():.0f}s"
+                )
+                await cb.set_retry(error, delay)
+        else:
+            await cb.set_sent()
+
+    async def __give_up(self, cb: outbox.Callback, error: str) -> None:
+        logger.error(f"callback {cb.id} to {cb.url} failed: {error}, give up")
+        await cb.set_failed(error)
+        oplog = logs.Log(
+            level=logs.LogLevel.error,
+            category="callback sender",
+            title=f"callback {cb.id} to {cb.url} failed after {cb.attempts} attempts",
+            detail=error,
+        )
+        await oplog.save()
+
+    # Wait sending callbacks complete in grace, the others released.
+    async def __drain(self) -> None:
+        if len(self._tasks) == 0:
+            return
+
+        logger.info(f"wait {len(self._tasks)} sending callbacks complete")
+        _, pending = await asyncio.wait(self._tasks, timeout=self._grace)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -1,8 +1,22 @@
 import asyncio
+import os
+import socket
+import time
+from collections.abc import AsyncIterable, AsyncIterator, Mapping
+from contextlib import asynccontextmanager
+from typing import Any
+from urllib.parse import urlsplit
+from beanie import PydanticObjectId
 from loguru import logger
-from models import inferences, logs
-from datetime import datetime
+from pymongo.errors import OperationFailure, PyMongoError
+from models import inferences, logs, outbox
+from datetime import timedelta
 import httpx
+import httpclient
+import backends
+import scheduling
+import persistence.sysconf
+from persistence.sysconf import RequestMode
 import oss
 import base64
 from pydantic import BaseModel
@@ -14,85 +28,390 @@ class InferenceRequest(BaseModel):
     text_prompt: str | None = None
 
 
+# Max tasks process at same time of each task class, a heaven album
+# send many requests so it should not take all slots.
+DEFAULT_CONCURRENCY: dict[type[inferences.Inference], int] = {
+    inferences.StandardTask: 8,
+    inferences.HeavenAlbum: 2,
+}
+
+# Max requests of one heaven album send at same time.
+PROMPT_CONCURRENCY = 12
+
+# TODO: change timeout be a config params.
+TASK_TIMEOUT = 1800
+# Poll waiting tasks when change stream not available.
+POLL_INTERVAL = 1
+# Still claim even no change received when watching, in case some missed.
+RECONCILE_INTERVAL = 10
+WATCH_RETRY_INTERVAL = 5
+
+# Standalone mongodb not support change stream.
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+# Changes may make a task waiting, new task inserted or state updated.
+WAITING_CHANGES = [
+    {
+        "$match": {
+            "$or": [
+                {
+                    "operationType": {"$in": ["insert", "replace"]},
+                    "fullDocument.state": inferences.State.waiting.value,
+                },
+                {
+                    "operationType": "update",
+                    "updateDescription.updatedFields.state": (
+                        inferences.State.waiting.value
+                    ),
+                },
+            ]
+        }
+    }
+]
+
+# Claimed task belongs to worker until lease expired, renewed while processing.
+LEASE = 60
+HEARTBEAT_INTERVAL = 20
+REAP_INTERVAL = 30
+REAP_BATCH = 50
+# Expired task put back to waiting until claimed this many times, then error.
+MAX_ATTEMPTS = 3
+# Tasks claimed before lease exists, treat as expired after timeout.
+LEGACY_CLAIM_TIMEOUT = timedelta(seconds=TASK_TIMEOUT)
+# Wait running tasks complete when shutdown, the others put back to waiting.
+SHUTDOWN_GRACE = 30
+
+
+# Identify this process, set to task claimed by it.
+def default_worker_name() -> str:
+    return f"inference-dispatcher:{socket.gethostname()}:{os.getpid()}"
+
+
+# Tasks keep url of service host, route them to every host in config.
+# Return request mode of each endpoint path.
+async def load_inference_config() -> dict[str, RequestMode]:
+    conf = await persistence.sysconf.InferenceConfig.all().first_or_none()
+    if not conf:
+        logger.warning("no inference config, send tasks to their own url")
+        return {}
+    backends.register([conf.service_host, *conf.backends])
+    return dict(conf.request_modes)
+
+
+# Keyword arguments of post to send image and prompt in request mode.
+# Image in oss streamed from it while sending, only json read it whole.
+@asynccontextmanager
+async def request_body(
+    mode: RequestMode,
+    source: inferences.DataSource,
+    image: str,
+    prompt: str | None,
+) -> AsyncIterator[dict[str, Any]]:
+    if source == inferences.DataSource.in_place:
+        if mode == RequestMode.json:
+            yield _json_body(image, prompt)
+        else:
+            data = base64.b64decode(image)
+            yield _binary_body(mode, data, len(data), "", "image", prompt)
+        return
+
+    async with oss.load_file(image) as fp:
+        if mode == RequestMode.json:
+            yield _json_body(base64.b64encode(await fp.read()).decode(), prompt)
+        else:
+            yield _binary_body(
+                mode,
+                fp.chunks(),
+                fp.length,
+                fp.content_type,
+                fp.filename or "image",
+                prompt,
+            )
+
+
+def _json_body(image: str, prompt: str | None) -> dict[str, Any]:
+    req = InferenceRequest(init_image=image, text_prompt=prompt)
+    return {"json": req.model_dump(exclude_none=True)}
+
+
+def _binary_body(
+    mode: RequestMode,
+    content: bytes | AsyncIterable[bytes],
+    length: int,
+    content_type: str,
+    filename: str,
+    prompt: str | None,
+) -> dict[str, Any]:
+    content_type = content_type or "application/octet-stream"
+    fields = {"text_prompt": prompt} if prompt is not None else {}
+
+    if mode == RequestMode.raw:
+        headers = {"Content-Type": content_type, "Content-Length": str(length)}
+        return {"content": content, "headers": headers, "params": fields}
+
+    body = httpclient.MultipartStream(
+        fields, "init_image", filename, content_type, content, length
+    )
+    return {"content": body, "headers": body.headers}
+
+
 class Dispatcher:
 
+    def __init__(
+        self,
+        concurrency: Mapping[type[inferences.Inference], int] | None = None,
+        timeout: float = TASK_TIMEOUT,
+        prompt_concurrency: int = PROMPT_CONCURRENCY,
+        ordered: bool = True,
+        worker: str | None = None,
+        grace: float = SHUTDOWN_GRACE,
+        watch: bool = True,
+    ) -> None:
+        self._limits: dict[type[inferences.Inference], int] = dict(DEFAULT_CONCURRENCY)
+        self._limits.update(concurrency or {})
+        self._timeout: float = timeout
+
+        # Keep album data same order with prompts, or in order of complete.
+        self._prompt_concurrency: int = prompt_concurrency
+        self._ordered: bool = ordered
+
+        self._worker: str = worker if worker else default_worker_name()
+        self._lease: timedelta = timedelta(seconds=LEASE)
+        self._grace: float = grace
+
+        self._running: dict[type[inferences.Inference], int] = {
+            cls: 0 for cls in self._limits
+        }
+        self._inflight: set[PydanticObjectId] = set()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+        # Scheduler wakeup by change stream or slot freed, poll fast if not watching.
+        self._watch: bool = watch
+        self._watching: bool = False
+        self._wakeup: asyncio.Event = asyncio.Event()
+
+        self._modes: dict[str, RequestMode] = {}
+
     async def serve_forever(self) -> None:
+        self._modes = await load_inference_config()
+
+        heartbeat = asyncio.create_task(self.__heartbeat_forever())
+        watcher = asyncio.create_task(self.__watch_forever())
+        last_reap = 0.0
+
+        try:
+            while True:
+                try:
+                    if time.monotonic() - last_reap > REAP_INTERVAL:
+                        await self.__reap()
+                        last_reap = time.monotonic()
+
+                    # Clear before claim, changes during claim will wake us again.
+                    self._wakeup.clear()
+                    for cls in self._limits:
+                        await self.__fill(cls)
+
+                    interval = RECONCILE_INTERVAL if self._watching else POLL_INTERVAL
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), interval)
+                    except TimeoutError:
+                        pass
+
+                except asyncio.CancelledError as e:
+                    raise e
+                except Exception as exc:
+                    logger.error(f"inference dispatcher serve error: {repr(exc)}")
+                    await self.__write_oplog(
+                        f"inference dispatcher server error {repr(exc)}"
+                    )
+                    await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            watcher.cancel()
+            await self.__drain()
+            heartbeat.cancel()
+            await asyncio.gather(watcher, heartbeat, return_exceptions=True)
+
+    # Wake scheduler when any task become waiting, stop watching and
+    # keep polling if mongodb not support change stream.
+    async def __watch_forever(self) -> None:
+        if not self._watch:
+            return
 
+        collection = inferences.Inference.get_pymongo_collection()
         while True:
             try:
-                waiting_tasks = (
-                    inferences.Inference.find(
-                        inferences.Inference.state == inferences.State.waiting,
-                        with_children=True,
-                    )
-                    .sort("+ctime")
-                    .limit(10)
-                )
+                async with await collection.watch(WAITING_CHANGES) as stream:
+                    self._watching = True
+                    self._wakeup.set()
+                    logger.info("watching inference changes")
 
-                async for task in waiting_tasks:
-                    logger.info(f"find waiting task {task.id}")
+                    async for _ in stream:
+                        self._wakeup.set()
 
-                    # TODO: change timeout be a config params.
-                    try:
-                        async with asyncio.timeout(1800):
-                            await self.__serve_next(task)
-                            await self.__callback(task)
-                    except asyncio.TimeoutError:
-                        task.state = inferences.State.error
-                        task.utime = datetime.now()
-                        await task.save()
+            except asyncio.CancelledError as e:
+                raise e
+            except OperationFailure as exc:
+                if exc.code == CHANGE_STREAM_NOT_SUPPORTED:
+                    logger.warning("change stream not supported, poll waiting tasks")
+                    return
+                logger.error(f"watch inference changes error: {repr(exc)}")
+            except PyMongoError as exc:
+                logger.error(f"watch inference changes error: {repr(exc)}")
+            finally:
+                self._watching = False
+
+            await asyncio.sleep(WATCH_RETRY_INTERVAL)
+
+    # Wait running tasks complete in grace, the others cancelled and released.
+    async def __drain(self) -> None:
+        if len(self._tasks) == 0:
+            return
 
-                await asyncio.sleep(1)
+        logger.info(f"wait {len(self._tasks)} running inference tasks complete")
+        _, pending = await asyncio.wait(self._tasks, timeout=self._grace)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
+    async def __heartbeat_forever(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                if len(self._inflight) != 0:
+                    await inferences.Inference.renew_leases(
+                        list(self._inflight), self._worker, self._lease
+                    )
             except asyncio.CancelledError as e:
                 raise e
             except Exception as exc:
-                logger.error(f"inference dispatcher serve error: {repr(exc)}")
-                oplog = logs.Logs(
-                    level=logs.LogLevel.error,
-                    category="inference dispatcher",
-                    title=f"inference dispatcher server error {repr(exc)}",
-                    detail=traceback.format_exc(),
-                )
-                await oplog.save()
+                logger.error(f"renew inference task lease error: {repr(exc)}")
+
+    # Tasks of dead worker lease expired, put them back to waiting,
+    # or set error and callback if already tried too many times.
+    async def __reap(self) -> None:
+        for _ in range(REAP_BATCH):
+            task = await inferences.Inference.requeue_expired(
+                MAX_ATTEMPTS, LEGACY_CLAIM_TIMEOUT
+            )
+            if task is None:
+                break
+            logger.warning(f"task {task.id} lease expired, put back to waiting")
 
-    async def __serve_next(self, task: inferences.Inference) -> None:
-        await task.sync()
+        for _ in range(REAP_BATCH):
+            task = await inferences.Inference.fail_expired(
+                MAX_ATTEMPTS, LEGACY_CLAIM_TIMEOUT, "inference error, worker lost"
+            )
+            if task is None:
+                break
+            logger.error(f"task {task.id} lease expired {task.attempts} times, abort")
+            await self.__callback(task)
+
+    # Claim waiting tasks of class until its slots full, round robin between
+    # users, so one user never take all slots of a class.
+    # Other dispatcher processes may claim from same collection at same time,
+    # task claimed by them skipped, next fill will schedule again.
+    async def __fill(self, cls: type[inferences.Inference]) -> None:
+        free = self._limits[cls] - self._running[cls]
+        if free <= 0:
+            return
 
-        if task.state == inferences.State.waiting:
-            task.state = inferences.State.processing
-            task.utime = datetime.now()
-            await task.save()
-        else:
+        queues = await cls.waiting_by_user(free)
+        if len(queues) == 0:
             return
+        running = await cls.running_by_user()
+
+        for id in scheduling.weighted_round_robin(queues, running, {}, free):
+            task = await cls.claim(self._worker, self._lease, id)
+            if task is None:
+                continue
+
+            logger.info(f"claimed waiting task {task.id}, worker {self._worker}")
+            self.__spawn(task)
+
+    def __spawn(self, task: inferences.Inference) -> None:
+        cls = type(task)
+        self._running[cls] += 1
+        if task.id:
+            self._inflight.add(task.id)
 
+        async def run() -> None:
+            try:
+                async with asyncio.timeout(self._timeout):
+                    finished = await self.__serve_next(task)
+                if finished:
+                    await self.__callback(task)
+                else:
+                    logger.warning(
+                        f"task {task.id} no longer owned by {self._worker}, "
+                        "drop its result"
+                    )
+            except asyncio.CancelledError as e:
+                try:
+                    await task.release(self._worker)
+                except Exception as exc:
+                    logger.error(f"release task {task.id} error: {repr(exc)}")
+                raise e
+            except asyncio.TimeoutError:
+                if await task.finish(self._worker, inferences.State.error):
+                    await self.__callback(task)
+            except Exception as exc:
+                logger.error(f"process inference task {task.id} error: {repr(exc)}")
+                await self.__write_oplog(
+                    f"process inference task {task.id} error {repr(exc)}"
+                )
+            finally:
+                self._running[cls] -= 1
+                if task.id:
+                    self._inflight.discard(task.id)
+
+                # A slot freed, claim more.
+                self._wakeup.set()
+
+        t = asyncio.create_task(run())
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def __write_oplog(self, title: str) -> None:
+        oplog = logs.Log(
+            level=logs.LogLevel.error,
+            category="inference dispatcher",
+            title=title,
+            detail=traceback.format_exc(),
+        )
+        await oplog.save()
+
+    # Return whether final state set, false if task taken by others.
+    async def __serve_next(self, task: inferences.Inference) -> bool:
         if isinstance(task, inferences.StandardTask):
-            await self.__process_standard_task(task)
+            return await self.__process_standard_task(task)
         if isinstance(task, inferences.HeavenAlbum):
-            await self.__process_heaven_album_task(task)
+            return await self.__process_heaven_album_task(task)
+        return False
 
-    async def __process_standard_task(self, task: inferences.StandardTask) -> None:
+    async def __process_standard_task(self, task: inferences.StandardTask) -> bool:
         logger.info(f"process standard inference task {task.id}")
 
         # Sending request.
-        body = await self.__read_request_data(task.request)
-        resp = await self.__send_request(task.request.url, body)
+        req = task.request
+        resp = await self.__send_request(
+            req.url, req.image_source, req.image, req.aigc_prompt
+        )
         logger.debug(f"task have response, code {resp.code}, msg {resp.msg}")
 
         # Check result.
         if resp.code != 0:
             logger.error(f"task {task.id} encounter error, abort")
-            return await task.set_error(code=resp.code, msg=resp.msg)
+            return await task.set_error(self._worker, code=resp.code, msg=resp.msg)
 
         if resp.data and len(resp.data) > 0:
-            return await task.set_success(resp.data[0])
+            return await task.set_success(self._worker, resp.data[0])
         else:
             logger.error("inference response must set data.")
             return await task.set_error(
-                code=1, msg="invalid response data, data must be set."
+                self._worker, code=1, msg="invalid response data, data must be set."
             )
 
-    async def __process_heaven_album_task(self, task: inferences.HeavenAlbum) -> None:
+    async def __process_heaven_album_task(self, task: inferences.HeavenAlbum) -> bool:
 
         logger.info(
             f"process composite inference task {task.id}, total request {len(task.aigc_prompts)}"
@@ -103,71 +422,83 @@ class Dispatcher:
                 f"a waiting heaven album task should already have normalized piceture."
             )
             # TODO write oplog
-            return
-
-        logger.debug(f"loaded normalized picture from task {task.id}")
-        norimalized_picture: str = ""
-        async with oss.load_file(task.norimalized_picture) as fp:
-            norimalized_picture = base64.b64encode(await fp.read()).decode()
-
-        # Sending request one by one.
-        cnt: int = 0
-        for prompt in task.aigc_prompts:
-            logger.debug(
-                f"process {cnt}/{len(task.aigc_prompts)} of task {str(task.id)}"
+            return await task.set_error(
+                self._worker, code=1, msg="no normalized picture"
             )
 
-            req = InferenceRequest(init_image=norimalized_picture, text_prompt=prompt)
-            resp = await self.__send_request(task.inference_endpoint, req)
+        # Json encode picture once for all prompts, other modes stream it
+        # from oss for each request.
+        source = inferences.DataSource.gridfs
+        picture = task.norimalized_picture
+        if self.__mode(task.inference_endpoint) == RequestMode.json:
+            async with oss.load_file(picture) as fp:
+                picture = base64.b64encode(await fp.read()).decode()
+            source = inferences.DataSource.in_place
+            logger.debug(f"loaded normalized picture from task {task.id}")
+
+        # Sending requests in parallel, at most prompt concurrency at same time.
+        prompts = list(task.aigc_prompts)
+        await task.init_data(len(prompts) if self._ordered else 0)
+        slots = asyncio.Semaphore(self._prompt_concurrency)
+
+        async def process(index: int, prompt: str) -> None:
+            async with slots:
+                logger.debug(f"process {index + 1}/{len(prompts)} of task {task.id}")
+                resp = await self.__send_request(
+                    task.inference_endpoint, source, picture, prompt
+                )
 
             # Check response code.
             if resp.code != 0:
-                logger.error(f"task {task.id} encounter inference error, abort.")
+                logger.error(f"task {task.id} prompt {index} encounter inference error")
                 # TODO write oplogs
                 # TODO retry or use placeholder image.
-                continue
+                return
 
-            # Check result, set result if have, else abort task.
-            if resp.data and len(resp.data) > 0:
-                await task.add_data(resp.data[0])
-            else:
+            # Check result, set result if have, else skip this prompt.
+            if not resp.data or len(resp.data) == 0:
                 logger.error("inference response set result, but not found.")
                 # TODO write oplogs, retry or use placeholder image
-                continue
+                return
 
-            cnt += 1
+            if self._ordered:
+                await task.set_data(index, resp.data[0])
+            else:
+                await task.add_data(resp.data[0])
+
+        async with asyncio.TaskGroup() as tg:
+            for index, prompt in enumerate(prompts):
+                tg.create_task(process(index, prompt))
+
+        if self._ordered:
+            await task.compact_data()
 
         # TODO: it is not good because url may not stable.
         await task.add_data(f"http://localhost:8090/oss/file/{task.norimalized_picture}")
-        await task.set_success()
+        if not await task.set_success(self._worker):
+            return False
 
         logger.info(f"task {task.id} complete.")
+        return True
 
-    async def __read_request_data(self, req: inferences.Request) -> InferenceRequest:
-        match req.image_source:
-            case inferences.DataSource.in_place:
-                request = InferenceRequest(
-                    init_image=req.image, text_prompt=req.aigc_prompt
-                )
-                return request
-            case inferences.DataSource.gridfs:
-                async with oss.load_file(req.image) as fp:
-                    request = InferenceRequest(
-                        init_image=base64.b64encode(await fp.read()).decode(),
-                        text_prompt=req.aigc_prompt,
-                    )
-                    return request
+    def __mode(self, url: str) -> RequestMode:
+        return self._modes.get(urlsplit(url).path, RequestMode.json)
 
     async def __send_request(
-        self, url: str, body: InferenceRequest
+        self,
+        url: str,
+        source: inferences.DataSource,
+        image: str,
+        prompt: str | None,
     ) -> inferences.InferenceResult:
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
-                resp = await client.post(
-                    url=url, json=body.model_dump(exclude_none=True)
-                )
-                resp.raise_for_status()
-                return inferences.InferenceResult.model_validate_json(resp.content)
+            client = httpclient.get(httpclient.Profile.inference)
+            mode = self.__mode(url)
+            async with request_body(mode, source, image, prompt) as body:
+                async with backends.resolve(url) as target:
+                    resp = await client.post(url=target, **body)
+                    resp.raise_for_status()
+            return inferences.InferenceResult.model_validate_json(resp.content)
         except httpx.HTTPError as e:
             logger.error(f"inference request failed, {str(e)}")
             # TODO write oplogs
@@ -175,8 +506,10 @@ class Dispatcher:
                 code=1, msg=f"sending inference request error: {e}"
             )
 
+    # Only write callback to outbox, senders deliver it with retries,
+    # so slow receiver never hold a dispatch slot.
     async def __callback(self, task: inferences.Inference) -> None:
-        logger.debug(f"call task callback url {task.callback}")
+        logger.debug(f"enqueue task callback url {task.callback}")
 
         cb_data = inferences.CallbackData(userdata=task.userdata, state=task.state)
         if isinstance(task, inferences.StandardTask):
@@ -184,9 +517,7 @@ class Dispatcher:
         if isinstance(task, inferences.HeavenAlbum):
             cb_data.result = task.response
 
-        # FIXME temporary give a timeout 30s to avoid error logs, but still need to fix call back slow problems.
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            await client.post(url=task.callback, json=cb_data.model_dump())
+        await outbox.Callback.enqueue(task.callback, cb_data.model_dump(mode="json"))
 
 
 if __name__ == "__main__":
@@ -194,17 +525,59 @@ if __name__ == "__main__":
     from argparse import ArgumentParser
     from pymongo import AsyncMongoClient
     import models
+    import persistence
+    import callback_sender
 
     async def main() -> None:
         parser = ArgumentParser()
         parser.add_argument("url")
+        parser.add_argument(
+            "--standard-workers",
+            type=int,
+            default=DEFAULT_CONCURRENCY[inferences.StandardTask],
+        )
+        parser.add_argument(
+            "--heaven-album-workers",
+            type=int,
+            default=DEFAULT_CONCURRENCY[inferences.HeavenAlbum],
+        )
+        parser.add_argument(
+            "--prompt-concurrency", type=int, default=PROMPT_CONCURRENCY
+        )
+        parser.add_argument("--unordered", action="store_true")
+        parser.add_argument("--no-watch", action="store_true")
+        parser.add_argument("--http2", action="store_true")
+        parser.add_argument(
+            "--callback-concurrency",
+            type=int,
+            default=callback_sender.DEFAULT_CONCURRENCY,
+        )
         arguments = parser.parse_args()
 
         client = AsyncMongoClient(arguments.url)
         await models.init(client.aigc)
+        await persistence.init_presistence(client)
+        await httpclient.init(http2=arguments.http2)
+
+        dispatcher = Dispatcher(
+            {
+                inferences.StandardTask: arguments.standard_workers,
+                inferences.HeavenAlbum: arguments.heaven_album_workers,
+            },
+            prompt_concurrency=arguments.prompt_concurrency,
+            ordered=not arguments.unordered,
+            watch=not arguments.no_watch,
+        )
+        sender = callback_sender.Sender(arguments.callback_concurrency)
 
-        dispatcher = Dispatcher()
-        await dispatcher.serve_forever()
+        health_check = asyncio.create_task(backends.check_forever())
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(dispatcher.serve_forever())
+                tg.create_task(sender.serve_forever())
+        finally:
+            health_check.cancel()
+            await httpclient.close()
 
     try:
         asyncio.run(main())
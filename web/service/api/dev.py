@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
-from sqlmodel import Session, select
-from .. import deps, sessions
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .. import deps, points, sessions
 import database
 
 router = APIRouter()
@@ -24,15 +25,15 @@ class UserLoginRequest(BaseModel):
 # Add some API for dev
 @router.post("/user/register")
 async def register_user(
-    req: RegisterUserRequest, dbsession: Session = Depends(deps.get_db_session)
+    req: RegisterUserRequest, dbsession: AsyncSession = Depends(deps.get_db_session)
 ) -> APIResponse:
 
     u = database.user.User(
         username=req.username, nickname=req.nickname, avatar="avatar.jpg"
     )
     dbsession.add(u)
-    dbsession.commit()
-    dbsession.refresh(u)
+    await dbsession.commit()
+    await dbsession.refresh(u)
 
     assert u.id
 
@@ -40,7 +41,8 @@ async def register_user(
         uid=u.id, stype=database.subscription.Type.trail, init=1000, remains=1000
     )
     dbsession.add(s)
-    dbsession.commit()
+    await points.grant(dbsession, s)
+    await dbsession.commit()
 
     return APIResponse()
 
@@ -49,12 +51,12 @@ async def register_user(
 @router.post("/user/login")
 async def user_login(
     req: UserLoginRequest,
-    dbsession: Session = Depends(deps.get_db_session),
+    dbsession: AsyncSession = Depends(deps.get_db_session),
 ) -> APIResponse:
     query = select(database.user.User).where(
         database.user.User.username == req.username
     )
-    u = dbsession.exec(query).one_or_none()
+    u = (await dbsession.exec(query)).one_or_none()
     if u is None:
         return APIResponse(code=1, msg="no such user")
     assert u.id
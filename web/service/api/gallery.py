@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
-from .. import sessions, deps
+from .. import sessions, deps, infer_payload
 import sqlmodel
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Any
-import json
 import database
 
 
@@ -46,7 +46,7 @@ async def get_inference_history(
     start: int,
     count: int,
     ses: sessions.Session = Depends(deps.get_user_session),
-    db: sqlmodel.Session = Depends(deps.get_db_session),
+    db: AsyncSession = Depends(deps.get_db_session),
 ) -> APIResponse:
 
     selection = (
@@ -64,12 +64,12 @@ async def get_inference_history(
         .where(database.inference.Log.uid == ses.uid)
         .where(database.inference.Log.type != database.inference.Type.segment_any)
     )
-    total = db.exec(count_query).one()
+    total = (await db.exec(count_query)).one()
 
     result = GetInferenceHistoryWithPage(
         start=start, count=count, total=total, history=[]
     )
-    for row in db.exec(selection).all():
+    for row in (await db.exec(selection)).all():
         h = InferenceHistoryItem(
             tid=row.tid,
             type=str(row.type),
@@ -86,14 +86,14 @@ async def get_inference_history(
 async def get_inference_detail(
     tid: str,
     ses: sessions.Session = Depends(deps.get_user_session),
-    db: sqlmodel.Session = Depends(deps.get_db_session),
+    db: AsyncSession = Depends(deps.get_db_session),
 ) -> APIResponse:
     query = (
         sqlmodel.select(database.inference.Log)
         .where(database.inference.Log.uid == ses.uid)
         .where(database.inference.Log.tid == tid)
     )
-    log = db.exec(query).one_or_none()
+    log = (await db.exec(query)).one_or_none()
     if log is None:
         raise KeyError("no such inference request.")
 
@@ -106,10 +106,11 @@ async def get_inference_detail(
         request={},
         response={},
     )
+    # Large fields stored in oss, put them back as client sent.
     if log.request != "":
-        h.request = json.loads(log.request)
+        h.request = await infer_payload.loads(log.request)
     if log.response != "":
-        h.response = json.loads(log.response)
+        h.response = await infer_payload.loads(log.response)
 
     return APIResponse(data=h)
 
@@ -120,18 +121,18 @@ async def get_inference_detail(
 async def delete_inference_history(
     tid: str,
     ses: sessions.Session = Depends(deps.get_user_session),
-    dbsession: sqlmodel.Session = Depends(deps.get_db_session),
+    dbsession: AsyncSession = Depends(deps.get_db_session),
 ) -> APIResponse:
     query = (
         sqlmodel.select(database.inference.Log)
         .where(database.inference.Log.uid == ses.uid)
         .where(database.inference.Log.tid == tid)
     )
-    ilog = dbsession.exec(query).one_or_none()
+    ilog = (await dbsession.exec(query)).one_or_none()
 
     if ilog is not None:
-        dbsession.delete(ilog)
-        dbsession.commit()
+        await dbsession.delete(ilog)
+        await dbsession.commit()
         return APIResponse()
 
     return APIResponse(code=1, msg="no such inference history")
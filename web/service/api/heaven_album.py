@@ -7,13 +7,16 @@ from wechat.rpc import HeavenAlbum
 import persistence.sysconf
 from zhipuai_client import ZhipuaiClient
 import io
-import httpx
+import httpclient
+import backends
 
 import secrets
-from models import inferences, users
+import hashlib
+from gridfs.errors import NoFile
+from models import image_cache, inferences, users
 
 import imglib
-from PIL import Image, ImageChops
+import imgpool
 import asyncio
 import oss
 import secrets
@@ -58,66 +61,191 @@ class InferenceError(Exception):
     pass
 
 
-async def generate_background_mask(src: Image.Image) -> Image.Image:
-    url = "http://app4.zpanx.cn:8701" + "/segment_any"
-    req_body = InferenceRequest(
-        init_image=imglib.image_to_b64(src).decode(), segment_prompt="rmbg"
-    )
+# Encoding of images send to each endpoint path, as inference config set.
+def image_encodings(
+    conf: persistence.sysconf.InferenceConfig,
+) -> dict[str, imglib.Encoding]:
+    return {
+        path: imglib.Encoding(**enc.model_dump())
+        for path, enc in conf.image_encodings.items()
+    }
+
+
+# Version of results in image cache, bump when a step give different result
+# for same source, then old entries never hit.
+MASK_VERSION = "1"
+NORMALIZE_VERSION = "1"
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        response = await client.post(url, json=req_body.model_dump(exclude_none=True))
-        res = InferenceResponse.model_validate_json(response.content)
+SEGMENT_PATH = "/segment_any"
+REPLACE_PATH = "/replace_with_any"
 
-        if res.code != 0:
-            raise InferenceError(res.msg)
-        if res.result == None or res.result.rmbg_mask == None:
-            raise InferenceError("no segment result")
 
-        mask: Image.Image | None = None
-        async with imglib.open_remote_image(res.result.rmbg_mask) as raw:
-            mask = ImageChops.invert(raw)
+def encoding_of(encodings: dict[str, imglib.Encoding], path: str) -> imglib.Encoding:
+    return encodings.get(path, imglib.Encoding())
 
-        return mask
 
+# Results also depend on encoding of images backend receive.
+def mask_version(encodings: dict[str, imglib.Encoding]) -> str:
+    return f"{MASK_VERSION}:{encoding_of(encodings, SEGMENT_PATH).key}"
 
+
+def normalize_version(encodings: dict[str, imglib.Encoding]) -> str:
+    return (
+        f"{NORMALIZE_VERSION}:{mask_version(encodings)}:"
+        f"{encoding_of(encodings, REPLACE_PATH).key}"
+    )
+
+
+# Return mask as backend give, white is background.
+async def generate_background_mask(
+    src: imgpool.SharedArray, host: str, encodings: dict[str, imglib.Encoding]
+) -> bytes:
+    url = host + SEGMENT_PATH
+    encoding = encoding_of(encodings, SEGMENT_PATH)
+    init_image = await imgpool.run(imgpool.to_b64, src, encoding)
+    req_body = InferenceRequest(init_image=init_image.decode(), segment_prompt="rmbg")
+
+    client = httpclient.get(httpclient.Profile.inference)
+    async with backends.resolve(url) as target:
+        response = await client.post(
+            target, json=req_body.model_dump(exclude_none=True)
+        )
+        response.raise_for_status()
+    res = InferenceResponse.model_validate_json(response.content)
+
+    if res.code != 0:
+        raise InferenceError(res.msg)
+    if res.result == None or res.result.rmbg_mask == None:
+        raise InferenceError("no segment result")
+
+    return await imglib.read_remote(res.result.rmbg_mask)
+
+
+# Mask of same source reused from image cache, only run segment_any on miss.
+async def background_mask(
+    src: imgpool.SharedArray,
+    digest: str,
+    host: str,
+    encodings: dict[str, imglib.Encoding],
+) -> imgpool.SharedArray:
+    raw: bytes | None = None
+    cached = await image_cache.Entry.lookup(
+        image_cache.Kind.mask, digest, mask_version(encodings)
+    )
+    if cached:
+        try:
+            async with oss.load_file(cached.fid) as fp:
+                raw = await fp.read()
+            logger.info(f"background mask of {digest} found in cache")
+        except NoFile:
+            # Evicted just now.
+            pass
+
+    if raw is None:
+        raw = await generate_background_mask(src, host, encodings)
+        async with oss.save_file(f"mask/{digest}.png", "image/png") as writer:
+            await writer.write_bytes(raw)
+        await image_cache.Entry.put(
+            image_cache.Kind.mask,
+            digest,
+            mask_version(encodings),
+            writer.file_id,
+            len(raw),
+        )
+
+    return await imgpool.run(imgpool.load_inverted, raw)
+
+
+# Return encoded result image as backend give.
 async def generate_normalized_image(
-    src: Image.Image, mask: Image.Image, prompt: str
-) -> Image.Image:
-    url = "http://app4.zpanx.cn:8701" + "/replace_with_any"
+    src: imgpool.SharedArray,
+    mask: imgpool.SharedArray,
+    prompt: str,
+    host: str,
+    encodings: dict[str, imglib.Encoding],
+) -> bytes:
+    url = host + REPLACE_PATH
+    encoding = encoding_of(encodings, REPLACE_PATH)
+    init_image, mask_image = await asyncio.gather(
+        imgpool.run(imgpool.to_b64, src, encoding),
+        imgpool.run(imgpool.to_b64, mask, encoding.for_mask()),
+    )
     req = InferenceRequest(
-        init_image=imglib.image_to_b64(src).decode(),
-        mask_image=imglib.image_to_b64(mask).decode(),
+        init_image=init_image.decode(),
+        mask_image=mask_image.decode(),
         text_prompt=prompt,
     )
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        response = await client.post(url, json=req.model_dump(exclude_none=True))
+    client = httpclient.get(httpclient.Profile.inference)
+    async with backends.resolve(url) as target:
+        response = await client.post(target, json=req.model_dump(exclude_none=True))
+        response.raise_for_status()
 
-        res = InferenceResponse.model_validate_json(response.content)
+    res = InferenceResponse.model_validate_json(response.content)
 
-        if res.code != 0:
-            raise InferenceError(res.msg)
-        if res.result == None or res.result.image == None:
-            raise InferenceError("no inference result")
+    if res.code != 0:
+        raise InferenceError(res.msg)
+    if res.result == None or res.result.image == None:
+        raise InferenceError("no inference result")
 
-        result: Image.Image | None = None
-        async with imglib.open_remote_image(res.result.image) as img:
-            result = img.copy()
+    return await imglib.read_remote(res.result.image)
 
-        return result
 
+# Decode input once, scale and extend to 1920x1080 in one pass, return
+# normalized image encoded as png. Digest is sha256 of source data.
+async def normailize_input_image(
+    data: bytes, digest: str, host: str, encodings: dict[str, imglib.Encoding]
+) -> bytes:
+    # Pixels stay in shared memory of image workers, only handles pass here.
+    extended = await imgpool.run(imgpool.letterbox, data)
+    mask: imgpool.SharedArray | None = None
 
-async def normailize_input_image(url: str) -> Image.Image:
-    res: Image.Image | None = None
-
-    async with imglib.open_remote_image(url) as ipt:
-        stretched = await asyncio.to_thread(imglib.keep_ratio_stretch_to_height, ipt)
-        extended = await asyncio.to_thread(imglib.resize, stretched)
-        mask = await generate_background_mask(extended)
+    try:
+        mask = await background_mask(extended, digest, host, encodings)
         text_prompt = "A surreal cosmic starry sky, vast glowing nebulae, luminous galaxies, dreamy aurora-like lights, surrealism style, vibrant colors, deep blues and purples with glowing pink and teal highlights, ultra-detailed, cinematic, ethereal atmosphere"
-        res = await generate_normalized_image(extended, mask, prompt=text_prompt)
+        res = await generate_normalized_image(
+            extended, mask, prompt=text_prompt, host=host, encodings=encodings
+        )
+    finally:
+        extended.unlink()
+        if mask is not None:
+            mask.unlink()
+
+    # Backend mostly give png already, store it as is.
+    return await imgpool.run(imgpool.to_png, res)
+
+
+# Return file id of normalized picture for source at url. Users often retry
+# with same photo, picture of earlier task with same source is shared.
+async def normalized_picture(
+    url: str, host: str, encodings: dict[str, imglib.Encoding]
+) -> str:
+    data = await imglib.read_remote(url)
+    digest = hashlib.sha256(data).hexdigest()
+
+    cached = await image_cache.Entry.lookup(
+        image_cache.Kind.normalized, digest, normalize_version(encodings)
+    )
+    if cached:
+        logger.info(f"normalized picture of {digest} found in cache")
+        return cached.fid
 
-    return res
+    picture = await normailize_input_image(data, digest, host, encodings)
+    del data
+
+    async with oss.save_file(f"{secrets.token_hex(8)}.png", "image/png") as writer:
+        await writer.write_bytes(picture)
+
+    # Tasks keep referencing the picture, cache never delete it.
+    await image_cache.Entry.put(
+        image_cache.Kind.normalized,
+        digest,
+        normalize_version(encodings),
+        writer.file_id,
+        len(picture),
+        owned=False,
+    )
+    return writer.file_id
 
 
 router = APIRouter(prefix="/heaven_album")
@@ -136,6 +264,8 @@ class UploadResp(BaseModel):
 async def prepare_inference(
     tid: str,
     ai_conf: persistence.sysconf.ZhipuaiConfig,
+    host: str,
+    encodings: dict[str, imglib.Encoding],
 ) -> None:
 
     logger.info(f"preparing task {tid}")
@@ -145,13 +275,8 @@ async def prepare_inference(
         logger.error(f"try prepare task, but no such task {tid}")
         return
 
-    async with oss.save_file(f"{secrets.token_hex(8)}.png", "image/png") as writer:
-        norimalized_input = await normailize_input_image(task.picture)
-        buf = io.BytesIO()
-        await asyncio.to_thread(norimalized_input.save, buf, "png")
-        await writer.write_bytes(buf.getvalue())
-        task.norimalized_picture = writer.file_id
-        await task.save()
+    task.norimalized_picture = await normalized_picture(task.picture, host, encodings)
+    await task.save()
 
     ai_client = ZhipuaiClient(ai_conf.apikey)
 
@@ -209,7 +334,13 @@ async def create_heaven_album_task(
     await task.save()
     logger.info(f"append inference task {str(task.id)}")
 
-    bg.add_task(prepare_inference, str(task.id), zhipuai_conf)
+    bg.add_task(
+        prepare_inference,
+        str(task.id),
+        zhipuai_conf,
+        infer_conf.service_host,
+        image_encodings(infer_conf),
+    )
 
     return APIResponse()
 
@@ -237,13 +368,13 @@ async def task_down_callback(req: inferences.CallbackData) -> APIResponse:
 
             # FIXME this part too long.
             images = []
+            client = httpclient.get(httpclient.Profile.download)
             for url in req.result.data:
-                async with httpx.AsyncClient() as client:
-                    resp = await client.get(url)
-                    path = f"result/{req.userdata}/{secrets.token_hex(3)}.jpg"
-                    file_id = await cloud_storage.upload(path, io.BytesIO(resp.content))
-                    logger.info(f"uploaded file id: {file_id}")
-                    images.append(file_id)
+                resp = await client.get(url)
+                path = f"result/{req.userdata}/{secrets.token_hex(3)}.jpg"
+                file_id = await cloud_storage.upload(path, io.BytesIO(resp.content))
+                logger.info(f"uploaded file id: {file_id}")
+                images.append(file_id)
 
             # TODO Append normalized picture as a result.
 
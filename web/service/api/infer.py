@@ -1,97 +1,36 @@
+import asyncio
 import json
 from collections.abc import AsyncIterator, Callable, Coroutine
-from contextlib import asynccontextmanager
-from datetime import datetime
-from typing import Any
+from typing import Annotated, Any
 
+import gridfs.errors
 import httpx
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.routing import APIRoute
 from loguru import logger
-from pydantic import BaseModel, ValidationError
-from sqlalchemy import Engine
-from sqlmodel import Session, select
-
-from .. import config, deps, infer_dispatch, prompt_translate, sessions
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .. import (
+    config,
+    deps,
+    infer_dispatch,
+    infer_payload,
+    points,
+    prompt_translate,
+    sessions,
+)
 import database
 
 
-# Exception raised when user try call infer API but do not have enough points.
-class NoPointError(Exception):
-    def __init__(self, uid: int) -> None:
-        self.uid = uid
-
-
 # Model use to prase infer API response, just check response code.
 class InferResponse(BaseModel):
     code: int
 
 
-# query current uesr subscription from database.
-async def get_current_subscription(
-    uid: int, db: Session
-) -> database.subscription.Subscription:
-    query = (
-        select(database.subscription.Subscription)
-        .where(database.subscription.Subscription.uid == uid)
-        .where(database.subscription.Subscription.expired == False)
-    )
-    subscriptions = db.exec(query).all()
-
-    trail: list[database.subscription.Subscription] = []
-    payed: list[database.subscription.Subscription] = []
-
-    for s in subscriptions:
-        if s.stype == database.subscription.Type.trail:
-            trail.append(s)
-        if s.stype == database.subscription.Type.subscription:
-            payed.append(s)
-
-    subscription: database.subscription.Subscription | None = None
-    if len(payed) != 0:
-        subscription = payed[0]
-    elif len(trail) != 0:
-        subscription = trail[0]
-    else:
-        raise AssertionError("no valid subscriptions")
-
-    return subscription
-
-
-# Class use to manage magic point, just wrapper subscription model and some functions.
-class PointManager:
-
-    def __init__(
-        self, subscription: database.subscription.Subscription, db: Session
-    ) -> None:
-        self._sub: database.subscription.Subscription = subscription
-        self._db: Session = db
-
-    @property
-    def magic_points(self) -> int:
-        return self._sub.remains
-
-    def deduct(self, point: int):
-        self._sub.remains -= point
-        self._sub.utime = datetime.now()
-        self._db.commit()
-
-    def recharge(self, point: int):
-        self._sub.remains += point
-        self._sub.utime = datetime.now()
-        self._db.commit()
-
-
-# Context manager wrap query subscription and deduct function.
-@asynccontextmanager
-async def point_manager(uid: int, db: Session) -> AsyncIterator[PointManager]:
-    sub = await get_current_subscription(uid, db)
-    mgr = PointManager(sub, db)
-
-    yield mgr
-
-
 # Custom route class use to handle exceptions raised during infer.
 class InferRoute(APIRoute):
 
@@ -128,13 +67,23 @@ class InferRoute(APIRoute):
                     content={"code": 2, "msg": "infer response invalid"}
                 )
 
-            # NoPointError will raise when user do not have enough point but try infer some.
-            except NoPointError as exc:
+            # Raise when user do not have enough point but try infer some.
+            except points.InsufficientPointsError as exc:
                 logger.info(f"user {exc.uid} do not have magic point")
                 return JSONResponse(
                     content={"code": 3, "msg": "magic point not enough"}
                 )
 
+            # Large fields of result stored in oss but file lost.
+            except gridfs.errors.NoFile as exc:
+                logger.error(f"inference result lost, {exc}")
+                return JSONResponse(
+                    content={
+                        "code": infer_dispatch.RESULT_LOST_CODE,
+                        "msg": "inference result lost",
+                    }
+                )
+
             # Raise when try to get background request from dict but no such key.
             except KeyError as exc:
                 logger.info(f"index error: uid or tid '{str(exc)}' no in dict.")
@@ -163,15 +112,23 @@ class CreateRequestResponse(APIResponse):
     tid: str
 
 
-# A dependence function to get a new point manager.
-async def get_point_manager(
-    ses: sessions.Session = Depends(deps.get_user_session),
-    dbses: Session = Depends(deps.get_db_session),
-) -> PointManager:
+# Max count of tids can query in one batch request.
+BATCH_LIMIT = 300
+
+
+# Request model to query many requests at once.
+class BatchRequest(BaseModel):
+    tids: list[str] = Field(min_length=1, max_length=BATCH_LIMIT)
 
-    sub = await get_current_subscription(ses.uid, dbses)
-    mgr = PointManager(sub, dbses)
-    return mgr
+
+# Response model of batch state query, request not found will not in states.
+class BatchStateResponse(APIResponse):
+    states: dict[str, str]
+
+
+# Response model of batch result query, request not complete has a code 10 result.
+class BatchResultResponse(APIResponse):
+    results: dict[str, Any]
 
 
 async def start_new_inference(
@@ -179,17 +136,19 @@ async def start_new_inference(
     uid: int,
     url: str,
     point: int,
-    pm: PointManager,
     request_body: dict[str, Any],
     translator: prompt_translate.ZhipuaiClient,
     inference_client: infer_dispatch.Client,
 ) -> CreateRequestResponse:
 
-    if pm.magic_points < point:
-        raise NoPointError(uid)
+    # Translation is paid, check points before it, new_inference reserve them.
+    await inference_client.check_points(uid, point)
 
+    # Translate client blocking, run it in thread.
     if "text_prompt" in request_body:
-        request_body["text_prompt"] = translator.translate(request_body["text_prompt"])
+        request_body["text_prompt"] = await asyncio.to_thread(
+            translator.translate, request_body["text_prompt"]
+        )
 
     tid = await inference_client.new_inference(type, uid, url, point, request_body)
 
@@ -205,7 +164,7 @@ router = APIRouter(prefix="/async/infer", route_class=InferRoute)
 async def get_req_state(
     tid: str,
     ses: deps.UserSession,
-    db: Engine = Depends(deps.get_db_engine),
+    db: AsyncEngine = Depends(deps.get_db_engine),
     inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
 ) -> GetStateResponse:
 
@@ -218,11 +177,13 @@ async def get_req_state(
         response.state = str(state)
 
     except (ValueError, KeyError):
-        with Session(db) as dbsession:
-            ilog = dbsession.exec(
-                select(database.inference.Log)
-                .where(database.inference.Log.uid == ses.uid)
-                .where(database.inference.Log.tid == tid)
+        async with AsyncSession(db) as dbsession:
+            ilog = (
+                await dbsession.exec(
+                    select(database.inference.Log)
+                    .where(database.inference.Log.uid == ses.uid)
+                    .where(database.inference.Log.tid == tid)
+                )
             ).one_or_none()
 
             if ilog is None:
@@ -233,6 +194,36 @@ async def get_req_state(
     return response
 
 
+# API to query state of many background requests in one query, no block.
+@router.post("/batch/state")
+async def get_batch_state(
+    req: BatchRequest,
+    ses: deps.UserSession,
+    inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
+) -> BatchStateResponse:
+    states = await inference_client.states(ses.uid, list(set(req.tids)))
+    return BatchStateResponse(
+        code=0, msg="ok", states={tid: str(state) for tid, state in states.items()}
+    )
+
+
+# API to get results of many requests in one query, no block.
+@router.post("/batch/result")
+async def get_batch_result(
+    req: BatchRequest,
+    ses: deps.UserSession,
+    inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
+) -> BatchResultResponse:
+    results = await inference_client.results(ses.uid, list(set(req.tids)))
+
+    response = BatchResultResponse(code=0, msg="ok", results={})
+    for tid, result in results.items():
+        if result is None:
+            result = {"code": 10, "msg": str(infer_dispatch.NotDownError(tid))}
+        response.results[tid] = result
+    return response
+
+
 # API to get result of a request if have, no block.
 @router.get("/{tid}/result")
 async def get_req_result(
@@ -255,6 +246,79 @@ async def wait_req_result(
     return JSONResponse(content=resp)
 
 
+# Send comment to keep connection alive when state not change.
+EVENTS_HEARTBEAT_INTERVAL = 15
+
+
+# Format inference log to a server sent event, use seq as event id, it only
+# grow while state may go back to waiting.
+async def format_state_event(log: database.inference.Log) -> str:
+    data: dict[str, Any] = {"tid": log.tid, "state": str(log.state)}
+    event = "state"
+
+    if log.state not in (
+        database.inference.State.waiting,
+        database.inference.State.in_progress,
+    ):
+        event = "result"
+        data["result"] = None
+        if log.response != "":
+            data["result"] = await infer_payload.loads(log.response)
+
+    return f"id: {log.seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# API to stream state changes and result of request by server sent events.
+@router.get("/{tid}/events")
+async def stream_req_events(
+    tid: str,
+    ses: deps.UserSession,
+    last_event_id: Annotated[str | None, Header()] = None,
+    inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
+) -> Response:
+
+    # Client reconnect, skip events already received.
+    last_seq = -1
+    if last_event_id and last_event_id.isdigit():
+        last_seq = int(last_event_id)
+
+    watcher = inference_client.watch(ses.uid, tid, EVENTS_HEARTBEAT_INTERVAL)
+
+    # Read first event here so no such inference still report as normal API.
+    first = await anext(watcher)
+
+    # Client already received result, no content stop browser reconnecting.
+    if (
+        first is not None
+        and first.seq <= last_seq
+        and first.state
+        not in (database.inference.State.waiting, database.inference.State.in_progress)
+    ):
+        await watcher.aclose()
+        return Response(status_code=204)
+
+    async def to_event(log: database.inference.Log | None) -> str:
+        if log is None:
+            return ": heartbeat\n\n"
+        if log.seq <= last_seq:
+            return ""
+        return await format_state_event(log)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            yield await to_event(first)
+            async for log in watcher:
+                yield await to_event(log)
+        finally:
+            await watcher.aclose()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # API to cancel waiting request
 @router.post("/{tid}/cancel")
 async def cancel_waiting_request(
@@ -272,7 +336,6 @@ async def cancel_waiting_request(
 async def replace_with_any(
     req: Request,
     ses: sessions.Session = Depends(deps.get_user_session),
-    pm: PointManager = Depends(get_point_manager),
     conf: config.Config = Depends(config.get_config),
     translator: prompt_translate.ZhipuaiClient = Depends(deps.get_translator),
     inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
@@ -284,7 +347,6 @@ async def replace_with_any(
         ses.uid,
         url,
         point,
-        pm,
         await req.json(),
         translator,
         inference_client,
@@ -296,7 +358,6 @@ async def replace_with_any(
 async def replace_with_reference(
     req: Request,
     ses: deps.UserSession,
-    pm: PointManager = Depends(get_point_manager),
     conf: config.Config = Depends(config.get_config),
     translator: prompt_translate.ZhipuaiClient = Depends(deps.get_translator),
     inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
@@ -309,7 +370,6 @@ async def replace_with_reference(
         ses.uid,
         url,
         point,
-        pm,
         await req.json(),
         translator,
         inference_client,
@@ -321,7 +381,6 @@ async def replace_with_reference(
 async def image_to_video(
     req: Request,
     ses: deps.UserSession,
-    pm: PointManager = Depends(get_point_manager),
     conf: config.Config = Depends(config.get_config),
     translator: prompt_translate.ZhipuaiClient = Depends(deps.get_translator),
     inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
@@ -333,7 +392,6 @@ async def image_to_video(
         ses.uid,
         url,
         point,
-        pm,
         await req.json(),
         translator,
         inference_client,
@@ -345,7 +403,6 @@ async def image_to_video(
 async def segment_any(
     req: Request,
     ses: deps.UserSession,
-    pm: PointManager = Depends(get_point_manager),
     conf: config.Config = Depends(config.get_config),
     translator: prompt_translate.ZhipuaiClient = Depends(deps.get_translator),
     inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
@@ -357,7 +414,6 @@ async def segment_any(
         ses.uid,
         url,
         point,
-        pm,
         await req.json(),
         translator,
         inference_client,
@@ -369,7 +425,6 @@ async def segment_any(
 async def edit_with_prompt(
     req: Request,
     ses: deps.UserSession,
-    pm: PointManager = Depends(get_point_manager),
     conf: config.Config = Depends(config.get_config),
     translator: prompt_translate.ZhipuaiClient = Depends(deps.get_translator),
     inference_client: infer_dispatch.Client = Depends(deps.get_inference_client),
@@ -392,7 +447,6 @@ async def edit_with_prompt(
         ses.uid,
         url,
         point,
-        pm,
         req_body,
         translator,
         inference_client,
@@ -4,7 +4,8 @@ import wechat
 from .. import deps, models, config, common
 from loguru import logger
 from datetime import datetime, timedelta
-from sqlmodel import select, Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 import database
 
 router = APIRouter(prefix="/payment")
@@ -14,7 +15,7 @@ router = APIRouter(prefix="/payment")
 async def open_payment(
     req: models.payment.OpenPaymentRequest,
     ses: deps.UserSession,
-    db: Session = Depends(deps.get_db_session),
+    db: AsyncSession = Depends(deps.get_db_session),
     conf: config.Config = Depends(config.get_config),
     wechat_conf: sysconf.wechat.Config = Depends(deps.get_wechat_conf),
     wx_client: wechat.client.WxClient = Depends(deps.get_wxclient),
@@ -36,8 +37,9 @@ async def open_payment(
     tradeid = wechat.make_nonce_str(16)
     desc = f"充值 {subplan.price / 100} 开通 {subplan.month} 月会员"
 
-    if wechat_conf.payment_expires:
-        expires_in = dt + timedelta(seconds=wechat_conf.payment_expires)
+    payment_expires = await wechat_conf.payment_expires()
+    if payment_expires:
+        expires_in = dt + timedelta(seconds=payment_expires)
     else:
         expires_in = dt + timedelta(seconds=7200)
 
@@ -45,13 +47,14 @@ async def open_payment(
         f"user open new recharge order {tradeid}, amount {req.amount / 100} CNY"
     )
 
-    if not wechat_conf.payment_callback_url:
+    payment_callback_url = await wechat_conf.payment_callback_url()
+    if not payment_callback_url:
         raise HTTPException(500, "wechat pay callback must be set first.")
 
     order = wechat.models.Order(
         description=desc,
         out_trade_no=tradeid,
-        notify_url=wechat_conf.payment_callback_url,
+        notify_url=payment_callback_url,
         amount=wechat.models.PayAmount(total=req.amount),
         time_expire=common.dt.format_datetime(expires_in),
     )
@@ -67,18 +70,22 @@ async def open_payment(
         expires=expires_in,
     )
     db.add(payment)
-    db.commit()
+    await db.commit()
 
     return models.payment.OpenPaymentResponse(url=url, tradeid=tradeid)
 
 
 @router.get("/state")
 async def get_payment_state(
-    tradeid: str, ses: deps.UserSession, db: Session = Depends(deps.get_db_session)
+    tradeid: str, ses: deps.UserSession, db: AsyncSession = Depends(deps.get_db_session)
 ) -> models.payment.GetPaymentStateResponse:
 
-    order = db.exec(
-        select(database.pay.Recharge).where(database.pay.Recharge.tradeid == tradeid)
+    order = (
+        await db.exec(
+            select(database.pay.Recharge).where(
+                database.pay.Recharge.tradeid == tradeid
+            )
+        )
     ).one_or_none()
     if order is None:
         logger.error(f"no such recharge order which trade id is {tradeid}")
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends
 from .. import deps, models
-from sqlmodel import select, Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import datetime
 import database
 
@@ -10,13 +11,15 @@ router = APIRouter(prefix="/user")
 @router.get("/info")
 async def user_info(
     ses: deps.UserSession,
-    db: Session = Depends(deps.get_db_session),
+    db: AsyncSession = Depends(deps.get_db_session),
 ) -> models.user.GetUserInfoResponse:
-    userinfo = db.get_one(database.user.User, ses.uid)
-    subscription = db.exec(
-        select(database.subscription.Subscription)
-        .where(database.subscription.Subscription.uid == ses.uid)
-        .where(database.subscription.Subscription.expired == False)
+    userinfo = await db.get_one(database.user.User, ses.uid)
+    subscription = (
+        await db.exec(
+            select(database.subscription.Subscription)
+            .where(database.subscription.Subscription.uid == ses.uid)
+            .where(database.subscription.Subscription.expired == False)
+        )
     ).all()
 
     # Subscription should have only one.
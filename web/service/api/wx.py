@@ -1,9 +1,10 @@
 from email.policy import HTTP
 from fastapi import APIRouter, Request, HTTPException, Response, Header, Depends
-from sqlmodel import select, Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from fastapi.responses import RedirectResponse
 
-from .. import deps, sessions, models, config, common
+from .. import deps, sessions, models, config, common, points
 import json
 from loguru import logger
 from datetime import datetime
@@ -26,7 +27,7 @@ router = APIRouter(prefix="/wx")
 async def wechat_login_callback(
     code: str,
     state: str,
-    db: Session = Depends(deps.get_db_session),
+    db: AsyncSession = Depends(deps.get_db_session),
     conf: config.Config = Depends(config.get_config),
     wx: wechat.client.WxClient = Depends(deps.get_wxclient),
 ):
@@ -43,9 +44,11 @@ async def wechat_login_callback(
         logger.error(f"fetch wx user info error, {e}")
         raise HTTPException(status_code=500, detail=e.msg)
 
-    exists_wxuinfo = db.exec(
-        select(database.wechat.UserInfo).where(
-            database.wechat.UserInfo.unionid == user_info.unionid
+    exists_wxuinfo = (
+        await db.exec(
+            select(database.wechat.UserInfo).where(
+                database.wechat.UserInfo.unionid == user_info.unionid
+            )
         )
     ).one_or_none()
 
@@ -53,7 +56,7 @@ async def wechat_login_callback(
     if exists_wxuinfo is not None:
         logger.debug(f"already have user {exists_wxuinfo.unionid}")
 
-        user = db.get(database.user.User, exists_wxuinfo.uid)
+        user = await db.get(database.user.User, exists_wxuinfo.uid)
         assert user is not None and user.id is not None
 
         # If already login and valid, use same one.
@@ -81,8 +84,8 @@ async def wechat_login_callback(
             wx_id=user_info.unionid,
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
 
         # Associate user and wx user info then write to database.
         assert new_user.id is not None
@@ -95,7 +98,7 @@ async def wechat_login_callback(
             unionid=user_info.unionid,
         )
         db.add(wx_record)
-        db.commit()
+        await db.commit()
 
         # Give a init point subscription.
         dt = datetime.now()
@@ -109,7 +112,8 @@ async def wechat_login_callback(
             utime=dt,
         )
         db.add(subscription)
-        db.commit()
+        await points.grant(db, subscription)
+        await db.commit()
 
         token = await sessions.create_new_session(new_user.id, new_user.nickname)
         logger.info(f"login with new token {token}")
@@ -124,7 +128,7 @@ async def wechat_pay_callback(
     wechatpay_timestamp: Annotated[str, Header()],
     wechatpay_nonce: Annotated[str, Header()],
     wechatpay_signature: Annotated[str, Header()],
-    db: Session = Depends(deps.get_db_session),
+    db: AsyncSession = Depends(deps.get_db_session),
     wx: wechat.client.WxClient = Depends(deps.get_wxclient),
     conf: config.Config = Depends(config.get_config),
 ) -> Response:
@@ -149,9 +153,11 @@ async def wechat_pay_callback(
     result = models.payment.PayCallbackResult.model_validate_json(plaintext)
     logger.debug(result.model_dump_json())
 
-    recharage_order = db.exec(
-        select(database.pay.Recharge).where(
-            database.pay.Recharge.tradeid == result.out_trade_no
+    recharage_order = (
+        await db.exec(
+            select(database.pay.Recharge).where(
+                database.pay.Recharge.tradeid == result.out_trade_no
+            )
         )
     ).one()
 
@@ -177,13 +183,15 @@ async def wechat_pay_callback(
         assert subplan is not None
 
         # Expire current subscription.
-        current_sub = db.exec(
-            select(database.subscription.Subscription)
-            .where(database.subscription.Subscription.uid == recharage_order.uid)
-            .where(database.subscription.Subscription.expired == False)
-            .where(
-                database.subscription.Subscription.stype
-                == database.subscription.Type.subscription
+        current_sub = (
+            await db.exec(
+                select(database.subscription.Subscription)
+                .where(database.subscription.Subscription.uid == recharage_order.uid)
+                .where(database.subscription.Subscription.expired == False)
+                .where(
+                    database.subscription.Subscription.stype
+                    == database.subscription.Type.subscription
+                )
             )
         ).one_or_none()
 
@@ -205,11 +213,12 @@ async def wechat_pay_callback(
             expires_in=expires_in,
         )
         db.add(newsub)
+        await points.grant(db, newsub)
         logger.info(
             f"uid {recharage_order.uid} new subscription, {subplan.price/100} for {subplan.month}, {subplan.points} each day."
         )
 
-    db.commit()
+    await db.commit()
 
     return Response()
 
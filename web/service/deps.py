@@ -1,8 +1,9 @@
 from typing import Annotated
-from collections.abc import Iterator
+from collections.abc import AsyncIterator
 from fastapi import Depends, Request, FastAPI, HTTPException, Header
-from sqlmodel import Session
-from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+import redis.asyncio as redis
 from . import infer_dispatch, sessions, config, prompt_translate
 import sysconf
 import wechat
@@ -12,12 +13,19 @@ def get_app(req: Request) -> FastAPI:
     return req.app
 
 
-def get_db_engine(app: FastAPI = Depends(get_app)) -> Engine:
+def get_db_engine(app: FastAPI = Depends(get_app)) -> AsyncEngine:
     return app.state.db
 
 
-def get_db_session(engine: Engine = Depends(get_db_engine)) -> Iterator[Session]:
-    with Session(engine) as s:
+def get_rdb(app: FastAPI = Depends(get_app)) -> redis.Redis:
+    return app.state.rdb
+
+
+# Objects still readable after commit, no lazy load allowed in async session.
+async def get_db_session(
+    engine: AsyncEngine = Depends(get_db_engine),
+) -> AsyncIterator[AsyncSession]:
+    async with AsyncSession(engine, expire_on_commit=False) as s:
         yield s
 
 
@@ -47,14 +55,16 @@ async def get_user_session(token: AuthToken) -> sessions.Session:
 UserSession = Annotated[sessions.Session, Depends(get_user_session)]
 
 
-def get_wechat_conf(db: Engine = Depends(get_db_engine)) -> sysconf.wechat.Config:
+def get_wechat_conf(
+    db: AsyncEngine = Depends(get_db_engine),
+) -> sysconf.wechat.Config:
     return sysconf.wechat.Config(db)
 
 
-def get_wxclient(
+async def get_wxclient(
     conf: sysconf.wechat.Config = Depends(get_wechat_conf),
 ) -> wechat.client.WxClient:
-    secrets = conf.secrets
+    secrets = await conf.secrets()
     if not secrets:
         raise HTTPException(500, "wechat secrets must be set property first")
     return wechat.client.new_client(secrets)
@@ -66,5 +76,14 @@ def get_translator(
     return prompt_translate.ZhipuaiClient(conf.prompt_translate.api_key)
 
 
-def get_inference_client(db: Engine = Depends(get_db_engine)) -> infer_dispatch.Client:
-    return infer_dispatch.Client(db)
+def get_waiters(app: FastAPI = Depends(get_app)) -> infer_dispatch.Waiters:
+    return app.state.waiters
+
+
+def get_inference_client(
+    db: AsyncEngine = Depends(get_db_engine),
+    rdb: redis.Redis = Depends(get_rdb),
+    waiters: infer_dispatch.Waiters = Depends(get_waiters),
+    conf: config.Config = Depends(config.get_config),
+) -> infer_dispatch.Client:
+    return infer_dispatch.Client(db, rdb, waiters, conf.infer.long_poll_timeout)
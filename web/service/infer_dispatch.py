@@ -1,19 +1,30 @@
 import json
+import os
 import secrets
-from collections.abc import Iterator
-from contextlib import contextmanager
-from datetime import datetime
-from typing import Any, Mapping
+import socket
+from collections import defaultdict
+from collections.abc import AsyncGenerator
+from datetime import datetime, timedelta
+from typing import Any, Mapping, Sequence
 
+import gridfs.errors
 import httpx
-from sqlalchemy import Engine
-from sqlmodel import Session, select, asc
+import httpclient
+import backends
+import scheduling
+import redis.asyncio as redis
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy import and_, func, or_, update
+from sqlmodel import select, asc, col
+from sqlmodel.ext.asyncio.session import AsyncSession
 from loguru import logger
 from pydantic import BaseModel
 import time
 import asyncio
 
 from database import inference, subscription
+from . import infer_payload, points
+from .config import InferConfig
 
 TOKEN_LEN = 8
 RESPONSE_UNSET = "response_unset"
@@ -22,6 +33,34 @@ READGROUP_NAME = "aigc:inference:stream:rg"
 CONSUMER_NAME = "aigc:inference:dispatc:server"
 INFERENCE_STATE_CHANNEL = "aigc:inference:state:notify"
 
+# Keep stream bounded, acked entries are useless once dispatched.
+STREAM_MAXLEN = 10000
+# Pending entries idle longer than this belong to a dead or busy consumer.
+RECLAIM_IDLE_MS = 60 * 1000
+RECLAIM_INTERVAL = 30
+READ_BLOCK_MS = 5000
+# Claim waiting logs even no message received, in case message lost.
+RECONCILE_INTERVAL = 30
+
+# Claimed log belongs to worker until lease expired, renewed while dispatching.
+LEASE_SECONDS = 60
+HEARTBEAT_INTERVAL = 20
+REAP_INTERVAL = 30
+REAP_BATCH = 50
+# Expired log put back to waiting until claimed this many times, then failed.
+MAX_ATTEMPTS = 3
+# Logs claimed before lease exists, treat as expired after this long.
+LEGACY_CLAIM_TIMEOUT = timedelta(hours=1)
+
+# Max responses of one batch load from oss at same time.
+REHYDRATE_CONCURRENCY = 16
+# Result code of inference whose large fields lost in oss.
+RESULT_LOST_CODE = 12
+
+# Share of a lane each user get, relative to users of other kind.
+SUBSCRIPTION_WEIGHT = 3
+TRAIL_WEIGHT = 1
+
 
 class NotDownError(Exception):
 
@@ -45,52 +84,101 @@ class InferenceStateUpdateMessage(BaseModel):
 class NewInferenceMessage(BaseModel):
     tid: str
     uid: int
+    type: inference.Type
     url: str
 
 
-# query current uesr subscription from database.
-@contextmanager
-def current_subscription(uid: int, db: Engine) -> Iterator[subscription.Subscription]:
-    query = (
-        select(subscription.Subscription)
-        .where(subscription.Subscription.uid == uid)
-        .where(subscription.Subscription.expired == False)
-    )
+# Identify this process, used as stream consumer name and claimer of logs.
+def default_worker_name() -> str:
+    return f"{CONSUMER_NAME}:{socket.gethostname()}:{os.getpid()}"
+
 
-    with Session(db) as session:
-        user_subscriptions = session.exec(query).all()
+async def publish_state(
+    rdb: redis.Redis, tid: str, uid: int, state: inference.State
+) -> None:
+    msg = InferenceStateUpdateMessage(tid=tid, uid=uid, state=state)
+    try:
+        await rdb.publish(INFERENCE_STATE_CHANNEL, msg.model_dump_json())
+    except redis.RedisError as exc:
+        # Waiters still wake up when timeout, just log it.
+        logger.warning(f"publish inference {tid} state failed, {exc}")
 
-    trail: list[subscription.Subscription] = []
-    payed: list[subscription.Subscription] = []
 
-    for s in user_subscriptions:
-        if s.stype == subscription.Type.trail:
-            trail.append(s)
-        if s.stype == subscription.Type.subscription:
-            payed.append(s)
+# Resolved with none when waiter should check state by itself.
+StateFuture = asyncio.Future[InferenceStateUpdateMessage | None]
 
-    s: subscription.Subscription | None = None
-    if len(payed) != 0:
-        s = payed[0]
-    elif len(trail) != 0:
-        s = trail[0]
-    else:
-        raise AssertionError("no valid subscriptions")
 
-    try:
-        yield s
-    except:
-        pass
-    else:
-        with Session(db) as session:
-            session.add(s)
-            session.commit()
+# Per process registry of waiting requests, state update only wake waiters of its tid.
+class Waiters:
+
+    def __init__(self) -> None:
+        self._waiters: dict[str, set[StateFuture]] = {}
+
+    def register(self, tid: str) -> StateFuture:
+        fut: StateFuture = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(tid, set()).add(fut)
+        return fut
+
+    def discard(self, tid: str, fut: StateFuture) -> None:
+        futs = self._waiters.get(tid)
+        if futs is None:
+            return
+        futs.discard(fut)
+        if len(futs) == 0:
+            del self._waiters[tid]
+
+    def notify(self, msg: InferenceStateUpdateMessage) -> None:
+        for fut in self._waiters.pop(msg.tid, set()):
+            if not fut.done():
+                fut.set_result(msg)
+
+    # Wake everyone to check state again, message may lost when reconnect.
+    def notify_all(self) -> None:
+        waiters, self._waiters = self._waiters, {}
+        for futs in waiters.values():
+            for fut in futs:
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def listen_forever(self, rdb: redis.Redis) -> None:
+        while True:
+            try:
+                async with rdb.pubsub() as pubsub:
+                    await pubsub.subscribe(INFERENCE_STATE_CHANNEL)
+                    self.notify_all()
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        try:
+                            msg = InferenceStateUpdateMessage.model_validate_json(
+                                message["data"]
+                            )
+                        except ValueError as exc:
+                            logger.error(f"invalid inference state message, {exc}")
+                            continue
+                        self.notify(msg)
+
+            except asyncio.CancelledError as e:
+                raise e
+            except Exception as exc:
+                logger.error(f"listen inference state error: {exc}")
+                await asyncio.sleep(1)
 
 
 class Client:
 
-    def __init__(self, db: Engine) -> None:
-        self._db: Engine = db
+    def __init__(
+        self,
+        db: AsyncEngine,
+        rdb: redis.Redis,
+        waiters: Waiters,
+        long_poll_timeout: int = 30,
+    ) -> None:
+        self._db: AsyncEngine = db
+        self._rdb: redis.Redis = rdb
+        self._waiters: Waiters = waiters
+        self._long_poll_timeout: int = long_poll_timeout
 
     async def new_inference(
         self,
@@ -102,99 +190,198 @@ class Client:
     ) -> str:
         token = secrets.token_hex(TOKEN_LEN)
 
-        with Session(self._db) as session:
+        async with AsyncSession(self._db) as session:
+            # Log only created when points reserved, reserve before upload
+            # large fields, nothing left in oss if points not enough.
+            await points.reserve(session, uid, token, point)
+
             log = inference.Log(
                 uid=uid,
                 tid=token,
                 type=type,
-                request=json.dumps(body),
+                request=await infer_payload.dumps(body),
                 point=point,
                 url=url,
             )
             session.add(log)
-            session.commit()
+            await session.commit()
 
-        with current_subscription(uid, self._db) as subscription:
-            subscription.remains -= point
+        # Row already committed, if enqueue failed server still claim it when
+        # reconcile, so never fail the request here.
+        msg = NewInferenceMessage(tid=token, uid=uid, type=type, url=url)
+        try:
+            await self._rdb.xadd(
+                STREAM_NAME,
+                {"data": msg.model_dump_json()},
+                maxlen=STREAM_MAXLEN,
+                approximate=True,
+            )
+        except redis.RedisError as exc:
+            logger.error(f"enqueue inference {token} error, wait reconcile: {exc}")
 
         logger.info(f"new inference {token}")
         return token
 
+    # Raise InsufficientPointsError if user obviously can not pay point.
+    async def check_points(self, uid: int, point: int) -> None:
+        async with AsyncSession(self._db) as session:
+            await points.check(session, uid, point)
+
     async def state(self, uid: int, tid: str) -> inference.State:
-        with Session(self._db) as session:
+        async with AsyncSession(self._db) as session:
             query = (
                 select(inference.Log)
                 .where(inference.Log.uid == uid)
                 .where(inference.Log.tid == tid)
             )
-            log = session.exec(query).one_or_none()
+            log = (await session.exec(query)).one_or_none()
         if log is None:
             raise KeyError("no such inference")
         return log.state
 
     async def result(self, uid: int, tid: str) -> Mapping[str, Any]:
-        with Session(self._db) as session:
+        async with AsyncSession(self._db) as session:
             query = (
                 select(inference.Log)
                 .where(inference.Log.uid == uid)
                 .where(inference.Log.tid == tid)
             )
-            log = session.exec(query).one_or_none()
+            log = (await session.exec(query)).one_or_none()
 
         if log is None:
             raise KeyError("no such inference")
         if log.response == "":
             raise NotDownError(tid)
-        return json.loads(log.response)
+        return await infer_payload.loads(log.response)
+
+    async def states(
+        self, uid: int, tids: Sequence[str]
+    ) -> dict[str, inference.State]:
+        query = (
+            select(inference.Log.tid, inference.Log.state)
+            .where(inference.Log.uid == uid)
+            .where(col(inference.Log.tid).in_(tids))
+        )
+        async with AsyncSession(self._db) as session:
+            rows = (await session.exec(query)).all()
+        return {tid: state for tid, state in rows}
+
+    # Results of complete inferences, none for those still in progress.
+    async def results(
+        self, uid: int, tids: Sequence[str]
+    ) -> dict[str, Mapping[str, Any] | None]:
+        query = (
+            select(inference.Log.tid, inference.Log.response)
+            .where(inference.Log.uid == uid)
+            .where(col(inference.Log.tid).in_(tids))
+        )
+        async with AsyncSession(self._db) as session:
+            rows = (await session.exec(query)).all()
+
+        # File of one result lost only fail that result.
+        slots = asyncio.Semaphore(REHYDRATE_CONCURRENCY)
+
+        async def load(tid: str, response: str) -> Mapping[str, Any] | None:
+            if response == "":
+                return None
+            async with slots:
+                try:
+                    return await infer_payload.loads(response)
+                except gridfs.errors.NoFile as exc:
+                    logger.error(f"result of inference {tid} lost: {exc}")
+                    return {"code": RESULT_LOST_CODE, "msg": "inference result lost"}
+
+        loaded = await asyncio.gather(*[load(tid, resp) for tid, resp in rows])
+        return {tid: result for (tid, _), result in zip(rows, loaded)}
 
     async def wait(self, uid: int, tid: str) -> Mapping[str, Any]:
+        query = (
+            select(inference.Log)
+            .where(inference.Log.uid == uid)
+            .where(inference.Log.tid == tid)
+        )
 
-        with Session(self._db) as session:
-            query = (
-                select(inference.Log)
-                .where(inference.Log.uid == uid)
-                .where(inference.Log.tid == tid)
-            )
-            log = session.exec(query).one_or_none()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._long_poll_timeout
 
-            if log is None:
-                raise KeyError("no such inference")
-
-            if log.response != "":
-                return json.loads(log.response)
+        while True:
+            # Register before query, so state changed between them still wake us.
+            fut = self._waiters.register(tid)
+            try:
+                async with AsyncSession(self._db) as session:
+                    log = (await session.exec(query)).one_or_none()
 
-        def do_wait(ilog: inference.Log):
-            while True:
-                time.sleep(1)
-                with Session(self._db) as ses:
-                    ses.add(ilog)
-                    ses.refresh(ilog)
+                if log is None:
+                    raise KeyError("no such inference")
 
-                    if ilog.state not in (
-                        inference.State.waiting,
-                        inference.State.in_progress,
-                    ):
-                        return
+                if log.state not in (
+                    inference.State.waiting,
+                    inference.State.in_progress,
+                ):
+                    break
 
-        await asyncio.to_thread(do_wait, log)
+                remains = deadline - loop.time()
+                if remains <= 0:
+                    raise NotDownError(tid)
 
-        with Session(self._db) as ses:
-            ses.add(log)
-            ses.refresh(log)
+                try:
+                    await asyncio.wait_for(fut, remains)
+                except TimeoutError:
+                    raise NotDownError(tid)
+            finally:
+                self._waiters.discard(tid, fut)
 
         if log.response == "":
             raise NotDownError(log.tid)
 
-        return json.loads(log.response)
+        return await infer_payload.loads(log.response)
+
+    # Yield log when its state changed until complete, none if nothing happen in interval.
+    async def watch(
+        self, uid: int, tid: str, interval: float
+    ) -> AsyncGenerator[inference.Log | None, None]:
+        query = (
+            select(inference.Log)
+            .where(inference.Log.uid == uid)
+            .where(inference.Log.tid == tid)
+        )
+
+        last: int | None = None
+        while True:
+            fut = self._waiters.register(tid)
+            try:
+                async with AsyncSession(self._db) as session:
+                    log = (await session.exec(query)).one_or_none()
+
+                if log is None:
+                    raise KeyError("no such inference")
+
+                if log.seq != last:
+                    last = log.seq
+                    yield log
+
+                    if log.state not in (
+                        inference.State.waiting,
+                        inference.State.in_progress,
+                    ):
+                        return
+
+                try:
+                    await asyncio.wait_for(fut, interval)
+                except TimeoutError:
+                    yield None
+            finally:
+                self._waiters.discard(tid, fut)
 
     async def cancel(self, uid: int, tid: str) -> None:
-        with Session(self._db) as session:
+        async with AsyncSession(self._db) as session:
             query = (
                 select(inference.Log)
                 .where(inference.Log.uid == uid)
                 .where(inference.Log.tid == tid)
+                .with_for_update()
             )
-            log = session.exec(query).one_or_none()
+            log = (await session.exec(query)).one_or_none()
 
             if log is None:
                 raise KeyError("no such inference")
@@ -206,92 +393,488 @@ class Client:
                     raise CancelError(f"inference {tid} already complete")
 
             log.state = inference.State.canceled
+            log.seq += 1
             resp: dict[str, int | str] = {
                 "code": 20,
                 "msg": "inference has been canceled",
             }
             log.response = json.dumps(resp)
             log.utime = datetime.now()
-            session.commit()
+            await points.refund(session, uid, tid, log.point)
+            await session.commit()
 
-            with current_subscription(uid, self._db) as subscription:
-                subscription.remains += log.point
+        await publish_state(self._rdb, tid, uid, inference.State.canceled)
 
 
 class Server:
 
-    def __init__(self, db: Engine) -> None:
-        self._db: Engine = db
+    def __init__(
+        self,
+        db: AsyncEngine,
+        rdb: redis.Redis,
+        conf: InferConfig,
+        worker: str | None = None,
+    ) -> None:
+        self._db: AsyncEngine = db
+        self._rdb: redis.Redis = rdb
+        self._worker: str = worker if worker else default_worker_name()
+        self._conf: InferConfig = conf
+
+        # Running dispatches, limit by workers in total and concurrency for each type.
+        self._running: dict[inference.Type, int] = {t: 0 for t in inference.Type}
+        self._limits: dict[inference.Type, int] = {
+            t: conf.concurrency.get(t.name, conf.workers) for t in inference.Type
+        }
+
+        # Lane set drained when no more waiting logs of its type, wakeup by new message.
+        self._wakeups: dict[inference.Type, asyncio.Event] = {
+            t: asyncio.Event() for t in inference.Type
+        }
+        self._drained: dict[inference.Type, bool] = {
+            t: False for t in inference.Type
+        }
+
+        # Messages acked only after lane drained, until then other replicas
+        # can reclaim them if this one has no free slots.
+        self._unacked: dict[inference.Type, set[str]] = {
+            t: set() for t in inference.Type
+        }
+
+        # Tid of running dispatches, their lease renewed by heartbeat.
+        self._inflight: set[str] = set()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def free_slots(self, type: inference.Type) -> int:
+        total = sum(self._running.values())
+        free = min(
+            self._limits[type] - self._running[type], self._conf.workers - total
+        )
+        return max(0, free)
+
+    # Pick tid of at most limit waiting logs of lane, round robin between users
+    # weighted by subscription, so one user never take all slots of a lane.
+    async def schedule(
+        self, session: AsyncSession, type: inference.Type, limit: int
+    ) -> list[str]:
+        Log = inference.Log
+
+        # Only first limit logs of each user can be picked.
+        rank = (
+            func.row_number()
+            .over(partition_by=col(Log.uid), order_by=asc(Log.ctime))
+            .label("rank")
+        )
+        waiting = (
+            select(Log.tid, Log.uid, Log.ctime, rank)
+            .where(Log.state == inference.State.waiting)
+            .where(Log.type == type)
+            .subquery()
+        )
+        rows = await session.exec(
+            select(waiting.c.tid, waiting.c.uid, waiting.c.ctime)
+            .where(waiting.c.rank <= limit)
+            .order_by(waiting.c.ctime)
+        )
+
+        queues: dict[int, list[tuple[str, datetime]]] = defaultdict(list)
+        for tid, uid, ctime in rows:
+            queues[uid].append((tid, ctime))
+        if len(queues) == 0:
+            return []
+
+        # Running logs of all replicas count, so fair across whole cluster.
+        running = await session.exec(
+            select(Log.uid, func.count())
+            .where(Log.state == inference.State.in_progress)
+            .where(Log.type == type)
+            .where(col(Log.uid).in_(list(queues)))
+            .group_by(col(Log.uid))
+        )
+
+        Sub = subscription.Subscription
+        paid = await session.exec(
+            select(Sub.uid)
+            .where(col(Sub.uid).in_(list(queues)))
+            .where(Sub.stype == subscription.Type.subscription)
+            .where(Sub.expired == False)
+        )
+        weights = {uid: TRAIL_WEIGHT for uid in queues}
+        weights.update({uid: SUBSCRIPTION_WEIGHT for uid in paid})
+
+        return scheduling.weighted_round_robin(
+            queues, {uid: n for uid, n in running}, weights, limit
+        )
+
+    # Move at most limit waiting logs to in progress in one transaction,
+    # rows locked by other replicas are skipped so each log claimed only once.
+    async def claim(self, type: inference.Type, limit: int) -> list[inference.Log]:
+        async with AsyncSession(self._db, expire_on_commit=False) as session:
+            tids = await self.schedule(session, type, limit)
+            if len(tids) == 0:
+                return []
+
+            # Log may be claimed by others after scheduled, check state again.
+            query = (
+                select(inference.Log)
+                .where(col(inference.Log.tid).in_(tids))
+                .where(inference.Log.state == inference.State.waiting)
+                .with_for_update(skip_locked=True)
+            )
+            logs = list((await session.exec(query)).all())
+            if len(logs) == 0:
+                return logs
+
+            now = datetime.now()
+            for log in logs:
+                log.state = inference.State.in_progress
+                log.seq += 1
+                log.worker = self._worker
+                log.claim_time = now
+                log.lease_until = now + timedelta(seconds=LEASE_SECONDS)
+                log.attempts += 1
+                log.utime = now
+                session.add(log)
+            await session.commit()
+
+        return logs
+
+    # Write result only if log still belong to this worker, lease may expire
+    # and log claimed by others, then result dropped and points untouched.
+    # Return whether result written.
+    async def _complete(
+        self, log: inference.Log, state: inference.State, response: str
+    ) -> bool:
+        now = datetime.now()
+        stmt = (
+            update(inference.Log)
+            .where(col(inference.Log.id) == log.id)
+            .where(col(inference.Log.worker) == self._worker)
+            .where(col(inference.Log.state) == inference.State.in_progress)
+            .values(
+                state=state,
+                response=response,
+                utime=now,
+                seq=col(inference.Log.seq) + 1,
+            )
+        )
+
+        async with AsyncSession(self._db, expire_on_commit=False) as session:
+            result = await session.exec(stmt)  # type: ignore
+            if result.rowcount != 1:
+                await session.rollback()
+                logger.warning(
+                    f"inference {log.tid} no longer owned by {self._worker}, "
+                    f"drop its {state.name} result"
+                )
+                return False
+
+            if state == inference.State.failed:
+                await points.refund(session, log.uid, log.tid, log.point)
+            elif state == inference.State.down:
+                await points.settle(session, log.uid, log.tid)
+            await session.commit()
+
+        log.response = response
+        log.state = state
+        log.utime = now
+        log.seq += 1
+        return True
+
+    async def dispatch(self, log: inference.Log) -> None:
+        url = log.url
+        tid = log.tid
+        point = log.point
 
-    def dispatch(self, log: inference.Log) -> None:
+        try:
+            body = await infer_payload.loads(log.request)
+            client = httpclient.get(httpclient.Profile.inference)
+            async with backends.resolve(url) as target:
+                resp = await client.post(url=target, json=body)
+                resp.raise_for_status()
 
-        with Session(self._db) as session:
-            session.add(log)
-            session.refresh(log)
+            # Response may carry images too, store large fields in oss.
+            try:
+                response = await infer_payload.dumps(resp.json())
+            except ValueError:
+                response = resp.content.decode()
 
-            if log.state == inference.State.canceled:
-                return
+            if await self._complete(log, inference.State.down, response):
+                await publish_state(self._rdb, tid, log.uid, log.state)
+                logger.info(f"inference {tid} complete.")
 
-            log.state = inference.State.in_progress
-            log.utime = datetime.now()
-            session.add(log)
-            session.commit()
-            session.refresh(log)
+        except (httpx.HTTPError, gridfs.errors.NoFile) as e:
+            response = json.dumps({"code": 1, "msg": f"inference error, {str(e)}"})
+            if await self._complete(log, inference.State.failed, response):
+                await publish_state(self._rdb, tid, log.uid, log.state)
+                logger.error(f"inference {tid} error, {e}, recharge point {point}")
 
-            url = log.url
-            body = json.loads(log.request)
-            tid = log.tid
-        
-        try:
-            with httpx.Client(timeout=None) as client:
-                resp = client.post(url=url, json=body)
-                resp.raise_for_status()
+    def spawn(self, log: inference.Log) -> None:
+        self._running[log.type] += 1
+        self._inflight.add(log.tid)
+
+        async def do_dispatch() -> None:
+            try:
+                await self.dispatch(log)
+            except asyncio.CancelledError as e:
+                await self.release(log)
+                raise e
+            except Exception as exc:
+                logger.error(f"unexpect error when dispatch {log.tid}: {exc}")
+            finally:
+                self._running[log.type] -= 1
+                self._inflight.discard(log.tid)
 
-                log.response = resp.content.decode()
-                log.state = inference.State.down
-                log.utime = datetime.now()
+                # A slot freed, lanes may claim more.
+                for t, drained in self._drained.items():
+                    if not drained:
+                        self._wakeups[t].set()
 
-            with Session(self._db) as session:
-                session.add(log)
-                session.commit()
+        task = asyncio.create_task(do_dispatch())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-            logger.info(f"inference {tid} complete.")
+    async def serve_lane(self, type: inference.Type) -> None:
+        wakeup = self._wakeups[type]
+        wakeup.set()
 
-        except httpx.HTTPError as e:
-            response = json.dumps({"code": 1, "msg": f"inference error, {str(e)}"})
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), RECONCILE_INTERVAL)
+            except TimeoutError:
+                self._drained[type] = False
+            wakeup.clear()
 
-            log.response = response
-            log.state = inference.State.failed
-            log.utime = datetime.now()
+            try:
+                free = self.free_slots(type)
+                if free == 0 or self._drained[type]:
+                    continue
+
+                logs = await self.claim(type, free)
+                for log in logs:
+                    logger.info(f"claimed inference {log.tid}, worker {self._worker}")
+                    await publish_state(self._rdb, log.tid, log.uid, log.state)
+                    self.spawn(log)
+
+                if len(logs) < free:
+                    self._drained[type] = True
+                    await self.ack(type)
+                else:
+                    wakeup.set()
 
-            with Session(self._db) as session:
+            except asyncio.CancelledError as e:
+                raise e
+            except Exception as exc:
+                logger.error(f"claim {type.name} inference error: {exc}")
+                await asyncio.sleep(1)
+
+    # Give up a log still dispatching, other worker can claim it at once.
+    async def release(self, log: inference.Log) -> None:
+        stmt = (
+            update(inference.Log)
+            .where(col(inference.Log.tid) == log.tid)
+            .where(col(inference.Log.worker) == self._worker)
+            .where(col(inference.Log.state) == inference.State.in_progress)
+            .values(
+                state=inference.State.waiting,
+                worker=None,
+                lease_until=None,
+                attempts=col(inference.Log.attempts) - 1,
+                seq=col(inference.Log.seq) + 1,
+                utime=datetime.now(),
+            )
+        )
+        try:
+            async with AsyncSession(self._db) as session:
+                await session.exec(stmt)  # type: ignore
+                await session.commit()
+            await publish_state(self._rdb, log.tid, log.uid, inference.State.waiting)
+            logger.info(f"release inference {log.tid}")
+        except Exception as exc:
+            logger.error(f"release inference {log.tid} error: {exc}")
+
+    # Extend lease of all running logs in one statement.
+    async def renew(self) -> None:
+        if len(self._inflight) == 0:
+            return
+
+        stmt = (
+            update(inference.Log)
+            .where(col(inference.Log.tid).in_(list(self._inflight)))
+            .where(col(inference.Log.worker) == self._worker)
+            .where(col(inference.Log.state) == inference.State.in_progress)
+            .values(lease_until=datetime.now() + timedelta(seconds=LEASE_SECONDS))
+        )
+        async with AsyncSession(self._db) as session:
+            await session.exec(stmt)  # type: ignore
+            await session.commit()
+
+    async def heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.renew()
+            except asyncio.CancelledError as e:
+                raise e
+            except Exception as exc:
+                logger.error(f"renew inference lease error: {exc}")
+
+    # Logs of dead worker lease expired, put them back to waiting,
+    # or fail and refund if already tried too many times.
+    async def reap(self) -> list[inference.Log]:
+        now = datetime.now()
+        query = (
+            select(inference.Log)
+            .where(inference.Log.state == inference.State.in_progress)
+            .where(
+                or_(
+                    col(inference.Log.lease_until) < now,
+                    and_(
+                        col(inference.Log.lease_until).is_(None),
+                        col(inference.Log.utime) < now - LEGACY_CLAIM_TIMEOUT,
+                    ),
+                )
+            )
+            .limit(REAP_BATCH)
+            .with_for_update(skip_locked=True)
+        )
+
+        async with AsyncSession(self._db, expire_on_commit=False) as session:
+            logs = list((await session.exec(query)).all())
+            for log in logs:
+                logger.warning(f"inference {log.tid} lease of {log.worker} expired")
+                if log.attempts < MAX_ATTEMPTS:
+                    log.state = inference.State.waiting
+                    log.worker = None
+                    log.lease_until = None
+                else:
+                    log.state = inference.State.failed
+                    log.response = json.dumps(
+                        {"code": 1, "msg": "inference error, worker lost"}
+                    )
+                    await points.refund(session, log.uid, log.tid, log.point)
+                log.seq += 1
+                log.utime = now
                 session.add(log)
-                session.commit()
-                session.refresh(log)
+            await session.commit()
 
-                tid = log.tid
-                point = log.point
+        return logs
 
-            with current_subscription(log.uid, self._db) as s:
-                s.remains += log.point
+    async def serve_reaper(self) -> None:
+        while True:
+            try:
+                for log in await self.reap():
+                    await publish_state(self._rdb, log.tid, log.uid, log.state)
+                    if log.state == inference.State.waiting:
+                        self._drained[log.type] = False
+                        self._wakeups[log.type].set()
+            except asyncio.CancelledError as e:
+                raise e
+            except Exception as exc:
+                logger.error(f"reap inference error: {exc}")
+            await asyncio.sleep(REAP_INTERVAL)
 
-            logger.error(f"inference {tid} error, {str(e)}, recharge point {point}")
+    # Wait running dispatches complete in grace, release the others.
+    async def drain(self, grace: float) -> None:
+        if len(self._tasks) == 0:
+            return
 
-    def serve_forever(self) -> None:
-        while True:
-            query = (
-                select(inference.Log)
-                .where(inference.Log.state == inference.State.waiting)
-                .order_by(asc(inference.Log.ctime))
-                .limit(10)
+        logger.info(f"wait {len(self._tasks)} running inferences complete")
+        _, pending = await asyncio.wait(self._tasks, timeout=grace)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def create_group(self) -> None:
+        try:
+            await self._rdb.xgroup_create(
+                STREAM_NAME, READGROUP_NAME, id="0", mkstream=True
             )
-            with Session(self._db) as session:
-                waiting_inference = session.exec(query).all()
+        except redis.ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    async def read(self) -> list[tuple[str, dict[str, str]]]:
+        entries = await self._rdb.xreadgroup(
+            READGROUP_NAME,
+            self._worker,
+            {STREAM_NAME: ">"},
+            count=10,
+            block=READ_BLOCK_MS,
+        )
+
+        messages: list[tuple[str, dict[str, str]]] = []
+        for _, items in entries or []:
+            messages.extend(items)
+        return messages
+
+    # Take over messages which delivered to other consumer but never acked.
+    async def reclaim(self) -> list[tuple[str, dict[str, str]]]:
+        result = await self._rdb.xautoclaim(
+            STREAM_NAME,
+            READGROUP_NAME,
+            self._worker,
+            min_idle_time=RECLAIM_IDLE_MS,
+            start_id="0-0",
+            count=10,
+        )
+        return [(mid, fields) for mid, fields in result[1] if fields]
+
+    # Message only tell there is new waiting log, mysql decide who claim it.
+    async def handle(self, mid: str, fields: dict[str, str]) -> None:
+        try:
+            msg = NewInferenceMessage.model_validate_json(fields["data"])
+        except (KeyError, ValueError) as exc:
+            logger.error(f"drop invalid inference message {mid}, {exc}")
+            await self._rdb.xack(STREAM_NAME, READGROUP_NAME, mid)
+            return
+
+        self._unacked[msg.type].add(mid)
+        self._drained[msg.type] = False
+        self._wakeups[msg.type].set()
+
+    # No waiting log of lane left, messages of it all served.
+    async def ack(self, type: inference.Type) -> None:
+        mids = self._unacked[type]
+        if len(mids) == 0:
+            return
+
+        self._unacked[type] = set()
+        await self._rdb.xack(STREAM_NAME, READGROUP_NAME, *mids)
 
+    async def serve_stream(self) -> None:
+        await self.create_group()
+
+        last_reclaim = 0.0
+        while True:
             try:
-                for i in waiting_inference:
-                    self.dispatch(i)
+                messages: list[tuple[str, dict[str, str]]] = []
+                if time.monotonic() - last_reclaim > RECLAIM_INTERVAL:
+                    messages.extend(await self.reclaim())
+                    last_reclaim = time.monotonic()
+                messages.extend(await self.read())
+
+                for mid, fields in messages:
+                    await self.handle(mid, fields)
+
+            except asyncio.CancelledError as e:
+                raise e
             except Exception as exc:
                 logger.error(f"unexpect error: {exc}")
+                await asyncio.sleep(1)
+
+    async def serve_forever(self) -> None:
+        pool = self._conf.pool()
+        backends.register([b.url for b in pool], [b.weight for b in pool])
 
-            time.sleep(1)
+        # Keep lease while draining, stop it after all dispatches done.
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(self.serve_stream())
+                tg.create_task(self.serve_reaper())
+                for t in inference.Type:
+                    tg.create_task(self.serve_lane(t))
+        finally:
+            await self.drain(self._conf.shutdown_grace)
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
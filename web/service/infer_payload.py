@@ -0,0 +1,187 @@
+import base64
+import binascii
+import hashlib
+import json
+from typing import Any
+
+from loguru import logger
+from sqlalchemy import func, or_
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select, update, col
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import inference
+import oss
+
+# String fields longer than this are moved to oss, log row keeps a reference.
+OFFLOAD_THRESHOLD = 16 * 1024
+REFERENCE_KEY = "$oss"
+
+
+def is_reference(value: Any) -> bool:
+    return isinstance(value, dict) and REFERENCE_KEY in value
+
+
+# Base64 text stored as decoded bytes, only when it can be encoded back exactly.
+def _to_bytes(value: str) -> tuple[bytes, str]:
+    try:
+        raw = base64.b64decode(value, validate=True)
+        if base64.b64encode(raw).decode() == value:
+            return raw, "base64"
+    except (binascii.Error, ValueError):
+        pass
+    return value.encode(), "text"
+
+
+async def _save(value: str) -> dict[str, Any]:
+    raw, encoding = _to_bytes(value)
+    digest = hashlib.sha256(raw).hexdigest()
+
+    # Same content uploaded before, reuse it.
+    fid = await oss.find_file({"sha256": digest})
+    if not fid:
+        async with oss.save_file(
+            f"inference/{digest}",
+            "application/octet-stream",
+            {"sha256": digest, "encoding": encoding},
+        ) as writer:
+            await writer.write_bytes(raw)
+            fid = writer.file_id
+
+    return {REFERENCE_KEY: fid, "sha256": digest, "encoding": encoding}
+
+
+async def _load(ref: dict[str, Any]) -> str:
+    async with oss.load_file(ref[REFERENCE_KEY]) as fp:
+        raw = await fp.read()
+
+    if ref.get("encoding") == "base64":
+        return base64.b64encode(raw).decode()
+    return raw.decode()
+
+
+# Replace large strings in json data with oss references.
+async def offload(data: Any) -> Any:
+    if isinstance(data, str) and len(data) > OFFLOAD_THRESHOLD:
+        return await _save(data)
+    if isinstance(data, dict):
+        return {k: await offload(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [await offload(v) for v in data]
+    return data
+
+
+# Replace oss references in json data with original content.
+async def rehydrate(data: Any) -> Any:
+    if is_reference(data):
+        return await _load(data)
+    if isinstance(data, dict):
+        return {k: await rehydrate(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [await rehydrate(v) for v in data]
+    return data
+
+
+async def dumps(data: Any) -> str:
+    return json.dumps(await offload(data))
+
+
+async def loads(text: str) -> Any:
+    return await rehydrate(json.loads(text))
+
+
+async def _compact_text(text: str) -> str | None:
+    if len(text) <= OFFLOAD_THRESHOLD:
+        return None
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    compacted = await dumps(data)
+    return compacted if len(compacted) < len(text) else None
+
+
+# Move large fields of logs written before offload into oss, walk table by id.
+# Whole table scanned, run it once by hand, not on every startup.
+async def compact_logs(db: AsyncEngine, batch: int = 50) -> int:
+    async def next_batch(last_id: int) -> list[tuple[int, str, str]]:
+        query = (
+            select(inference.Log.id, inference.Log.request, inference.Log.response)
+            .where(col(inference.Log.id) > last_id)
+            .where(
+                or_(
+                    func.length(inference.Log.request) > OFFLOAD_THRESHOLD,
+                    func.length(inference.Log.response) > OFFLOAD_THRESHOLD,
+                )
+            )
+            .order_by(col(inference.Log.id))
+            .limit(batch)
+        )
+        async with AsyncSession(db) as session:
+            rows = (await session.exec(query)).all()
+            return [(i, req, resp) for i, req, resp in rows if i]
+
+    async def save(id: int, values: dict[str, str]) -> None:
+        async with AsyncSession(db) as session:
+            await session.exec(
+                update(inference.Log)  # type: ignore
+                .where(col(inference.Log.id) == id)
+                .values(**values)
+            )
+            await session.commit()
+
+    last_id = 0
+    compacted = 0
+    while True:
+        try:
+            rows = await next_batch(last_id)
+        except Exception as exc:
+            logger.error(f"compact inference logs error: {exc}")
+            break
+        if len(rows) == 0:
+            break
+
+        for id, request, response in rows:
+            last_id = id
+            values: dict[str, str] = {}
+
+            new_request = await _compact_text(request)
+            if new_request is not None:
+                values["request"] = new_request
+            new_response = await _compact_text(response)
+            if new_response is not None:
+                values["response"] = new_response
+
+            if values:
+                await save(id, values)
+                compacted += 1
+
+    logger.info(f"compact inference logs complete, total {compacted}")
+    return compacted
+
+
+# python -m service.infer_payload <db url> <mongodb url>
+if __name__ == "__main__":
+
+    import asyncio
+    from argparse import ArgumentParser
+    from pymongo import AsyncMongoClient
+    import database
+
+    async def main() -> None:
+        parser = ArgumentParser()
+        parser.add_argument("db_url")
+        parser.add_argument("mongodb_url")
+        parser.add_argument("--batch", type=int, default=50)
+        arguments = parser.parse_args()
+
+        client = AsyncMongoClient(arguments.mongodb_url)
+        await oss.init(client.aigc)
+        db = database.create_async_engine(arguments.db_url)
+        try:
+            await compact_logs(db, arguments.batch)
+        finally:
+            await db.dispose()
+            await client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+from datetime import datetime
+
+from loguru import logger
+from sqlalchemy import case, update
+from sqlmodel import asc, col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import points, subscription
+
+# All functions here only add changes to session, caller commit them
+# with inference log in the same transaction.
+
+
+# Exception raised when user try reserve points but do not have enough.
+class InsufficientPointsError(Exception):
+
+    def __init__(self, uid: int) -> None:
+        self.uid: int = uid
+
+    def __str__(self) -> str:
+        return f"user {self.uid} do not have enough points"
+
+
+# Query id of subscription to charge, payed subscription first, then trail.
+async def current_subscription_id(session: AsyncSession, uid: int) -> int | None:
+    Sub = subscription.Subscription
+    query = (
+        select(Sub.id)
+        .where(Sub.uid == uid)
+        .where(Sub.expired == False)
+        .order_by(
+            case((col(Sub.stype) == subscription.Type.subscription, 0), else_=1),
+            asc(Sub.id),
+        )
+        .limit(1)
+    )
+    return (await session.exec(query)).first()
+
+
+# Check remains of subscription to charge without lock, reserve may still
+# fail, only save work before it when points obviously not enough.
+async def check(session: AsyncSession, uid: int, point: int) -> None:
+    sid = await current_subscription_id(session, uid)
+    if sid is None:
+        raise InsufficientPointsError(uid)
+
+    Sub = subscription.Subscription
+    remains = (await session.exec(select(Sub.remains).where(Sub.id == sid))).one()
+    if remains < point:
+        raise InsufficientPointsError(uid)
+
+
+# Change remains in database, never load subscription and write it back,
+# so concurrent requests will not lose update.
+async def _change_remains(session: AsyncSession, sid: int, delta: int) -> bool:
+    Sub = subscription.Subscription
+    stmt = (
+        update(Sub)
+        .where(col(Sub.id) == sid)
+        .values(remains=col(Sub.remains) + delta, utime=datetime.now())
+    )
+    if delta < 0:
+        stmt = stmt.where(col(Sub.remains) >= -delta)
+
+    result = await session.exec(stmt)  # type: ignore
+    return result.rowcount == 1
+
+
+# Record points of a new subscription, flush to get id of it.
+async def grant(session: AsyncSession, sub: subscription.Subscription) -> None:
+    await session.flush()
+    assert sub.id is not None
+
+    session.add(
+        points.Ledger(
+            uid=sub.uid, sid=sub.id, delta=sub.remains, reason=points.Reason.grant
+        )
+    )
+
+
+async def reserve(session: AsyncSession, uid: int, tid: str, point: int) -> None:
+    sid = await current_subscription_id(session, uid)
+    if sid is None or not await _change_remains(session, sid, -point):
+        raise InsufficientPointsError(uid)
+
+    session.add(
+        points.Ledger(
+            uid=uid, sid=sid, tid=tid, delta=-point, reason=points.Reason.reserve
+        )
+    )
+
+
+# Reserved points spent, nothing to change but record it.
+async def settle(session: AsyncSession, uid: int, tid: str) -> None:
+    reserved = await _reserved(session, tid)
+    if reserved is None:
+        return
+
+    session.add(
+        points.Ledger(
+            uid=uid, sid=reserved.sid, tid=tid, delta=0, reason=points.Reason.settle
+        )
+    )
+
+
+# Give reserved points back to the subscription they come from.
+async def refund(session: AsyncSession, uid: int, tid: str, point: int) -> None:
+    reserved = await _reserved(session, tid)
+
+    # Daily reset already restored the points, refund again give them twice.
+    if reserved is not None and await _reset_after(session, reserved):
+        session.add(
+            points.Ledger(
+                uid=uid, sid=reserved.sid, tid=tid, delta=0, reason=points.Reason.void
+            )
+        )
+        return
+
+    # Inference created before ledger, refund to current subscription.
+    sid = reserved.sid if reserved else await current_subscription_id(session, uid)
+    if sid is None:
+        logger.warning(f"no subscription to refund inference {tid} of user {uid}")
+        return
+
+    await _change_remains(session, sid, point)
+    session.add(
+        points.Ledger(
+            uid=uid, sid=sid, tid=tid, delta=point, reason=points.Reason.refund
+        )
+    )
+
+
+async def _reserved(session: AsyncSession, tid: str) -> points.Ledger | None:
+    query = (
+        select(points.Ledger)
+        .where(points.Ledger.tid == tid)
+        .where(points.Ledger.reason == points.Reason.reserve)
+    )
+    return (await session.exec(query)).one_or_none()
+
+
+# Reset lock subscription before write ledger, so its id is after every
+# reservation it covered.
+async def _reset_after(session: AsyncSession, reserved: points.Ledger) -> bool:
+    query = (
+        select(points.Ledger.id)
+        .where(points.Ledger.uid == reserved.uid)
+        .where(points.Ledger.sid == reserved.sid)
+        .where(points.Ledger.reason == points.Reason.reset)
+        .where(col(points.Ledger.id) > reserved.id)
+        .limit(1)
+    )
+    return (await session.exec(query)).first() is not None
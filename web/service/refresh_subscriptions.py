@@ -1,5 +1,5 @@
-from sqlmodel import select, Session
-from sqlalchemy import Engine
+from sqlmodel import col, select, Session
+from sqlalchemy import Engine, update
 from datetime import datetime, timedelta
 from loguru import logger
 import asyncio
@@ -16,29 +16,50 @@ def delay_to_next_middle_night(now: datetime) -> int:
 
 
 def refresh_subscriptions(db: Engine, dt: datetime):
+    Sub = database.subscription.Subscription
+    Ledger = database.points.Ledger
+
     with Session(db) as session:
-        subscriptions = session.exec(
-            select(database.subscription.Subscription).where(
-                database.subscription.Subscription.expired == False
-            )
+        expired = session.exec(
+            update(Sub)  # type: ignore
+            .where(col(Sub.expired) == False)
+            .where(col(Sub.expires_in) < dt)
+            .values(expired=True, utime=dt)
+        ).rowcount
+
+        # Lock subscriptions to reset, reserve and refund wait until ledger
+        # written, so remains in ledger always match the table.
+        rows = session.exec(
+            select(Sub.id, Sub.uid, Sub.init, Sub.remains)
+            .where(Sub.expired == False)
+            .with_for_update()
         ).all()
 
-        # Refresh subscriptions, if exipre, set state.
-        for s in subscriptions:
-            s.utime = dt
-
-            if s.expires_in is not None and dt > s.expires_in:
-                s.expired = True
-
-            else:
-                s.remains = s.init
-
-        log = database.subscription.RefreshLog(refresh_time=dt, cnt=len(subscriptions))
+        for sid, uid, init, remains in rows:
+            if init != remains:
+                session.add(
+                    Ledger(
+                        uid=uid,
+                        sid=sid,
+                        delta=init - remains,
+                        reason=database.points.Reason.reset,
+                        ctime=dt,
+                    )
+                )
+
+        session.exec(
+            update(Sub)  # type: ignore
+            .where(col(Sub.expired) == False)
+            .values(remains=col(Sub.init), utime=dt)
+        )
+
+        total = expired + len(rows)
+        log = database.subscription.RefreshLog(refresh_time=dt, cnt=total)
 
         session.add(log)
         session.commit()
 
-    logger.info(f"refresh subscrptions, total {len(subscriptions)}")
+    logger.info(f"refresh subscrptions, total {total}")
 
 
 def refresh_forever(db: Engine, delay_s: int):
@@ -2,6 +2,7 @@ from . import make_app
 import uvicorn
 import dataio
 import asyncio
+import httpclient
 
 
 async def main() -> None:
@@ -9,7 +10,10 @@ async def main() -> None:
 
     conf = uvicorn.Config(app=make_app())
     server = uvicorn.Server(conf)
-    await server.serve()
+    try:
+        await server.serve()
+    finally:
+        await httpclient.close()
 
 
 if __name__ == "__main__":
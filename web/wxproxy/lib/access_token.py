@@ -1,6 +1,7 @@
 from dataio import config, errors
 from datetime import datetime, timedelta
 import httpx
+import httpclient
 from pydantic import BaseModel
 
 _ENDPOINT = "https://api.weixin.qq.com/cgi-bin/token"
@@ -32,22 +33,22 @@ class AccessToken:
         conf = await self.__get_conf()
         req = _FetchAccessTokenRequest(appid=conf.appid, secret=conf.secret)
 
-        async with httpx.AsyncClient() as client:
-            try:
-                resp = await client.get(_ENDPOINT, params=req.model_dump())
-                resp.raise_for_status()
-                response = _FetchAccessTokenResponse.model_validate_json(resp.content)
-
-                conf.access_token = response.access_token
-                conf.access_token_expires = datetime.now() + timedelta(
-                    seconds=response.expires_in
-                )
-                await conf.save()
-                return conf.access_token
-
-            except httpx.HTTPError:
-                # TODO write oplogs
-                raise
+        client = httpclient.get()
+        try:
+            resp = await client.get(_ENDPOINT, params=req.model_dump())
+            resp.raise_for_status()
+            response = _FetchAccessTokenResponse.model_validate_json(resp.content)
+
+            conf.access_token = response.access_token
+            conf.access_token_expires = datetime.now() + timedelta(
+                seconds=response.expires_in
+            )
+            await conf.save()
+            return conf.access_token
+
+        except httpx.HTTPError:
+            # TODO write oplogs
+            raise
 
     async def token(self) -> str:
         conf = await self.__get_conf()
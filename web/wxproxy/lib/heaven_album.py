@@ -1,6 +1,6 @@
 from .access_token import AccessToken
 from dataio import config, errors
-import httpx
+import httpclient
 from typing import Sequence
 
 class HeavenAlbum:
@@ -18,16 +18,16 @@ class HeavenAlbum:
 
         access_token = AccessToken()
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                url=self.__INVOKE_FUNC_URL,
-                params={
-                    "access_token": await access_token.token(),
-                    "env": conf.cloud_env,
-                    "name": "aigc",
-                },
-                json={
-                    "func": "heaven_album:update_task",
-                    "params": {"tid": tid, "images": images, "state": state},
-                },
-            )
+        client = httpclient.get()
+        resp = await client.post(
+            url=self.__INVOKE_FUNC_URL,
+            params={
+                "access_token": await access_token.token(),
+                "env": conf.cloud_env,
+                "name": "aigc",
+            },
+            json={
+                "func": "heaven_album:update_task",
+                "params": {"tid": tid, "images": images, "state": state},
+            },
+        )
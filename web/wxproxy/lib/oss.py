@@ -1,5 +1,5 @@
 from .access_token import AccessToken
-import httpx
+import httpclient
 from pydantic import BaseModel
 from loguru import logger
 from dataio import config, errors
@@ -31,34 +31,34 @@ class WechatOSS:
 
         access_token = AccessToken()
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                "https://api.weixin.qq.com/tcb/uploadfile",
-                params={
-                    "access_token": await access_token.token(),
-                },
-                json={"env": conf.cloud_env, "path": filename},
-            )
-            upload_data = PreUploadData.model_validate_json(resp.content)
-            logger.trace(f"pre upload data:\n{upload_data}")
+        client = httpclient.get()
+        resp = await client.post(
+            "https://api.weixin.qq.com/tcb/uploadfile",
+            params={
+                "access_token": await access_token.token(),
+            },
+            json={"env": conf.cloud_env, "path": filename},
+        )
+        upload_data = PreUploadData.model_validate_json(resp.content)
+        logger.trace(f"pre upload data:\n{upload_data}")
 
-            resp = await client.post(
-                url=upload_data.url,
-                files={
-                    "key": filename,
-                    "Signature": upload_data.authorization,
-                    "x-cos-security-token": upload_data.token,
-                    "x-cos-meta-fileid": upload_data.cos_file_id,
-                    "file": buf.read(),
-                },
+        resp = await client.post(
+            url=upload_data.url,
+            files={
+                "key": filename,
+                "Signature": upload_data.authorization,
+                "x-cos-security-token": upload_data.token,
+                "x-cos-meta-fileid": upload_data.cos_file_id,
+                "file": buf.read(),
+            },
+        )
+        if resp.status_code != 204:
+            logger.error(
+                f"upload file {filename} failed, error message:\n{resp.text}"
+            )
+            raise UploadError(resp.text)
+        else:
+            logger.debug(
+                f"upload file {filename} ok, file id {upload_data.file_id}"
             )
-            if resp.status_code != 204:
-                logger.error(
-                    f"upload file {filename} failed, error message:\n{resp.text}"
-                )
-                raise UploadError(resp.text)
-            else:
-                logger.debug(
-                    f"upload file {filename} ok, file id {upload_data.file_id}"
-                )
-                return upload_data.file_id
+            return upload_data.file_id